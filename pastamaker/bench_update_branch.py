@@ -0,0 +1,184 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# NOTE: Compare the latency of the update_branch strategies against
+# a local stand-in of github:
+#
+# * git: the bare repositories are served with file:// urls, through a
+#   url.insteadOf of a temporary git configuration
+# * api: a http server handles PUT /repos/<owner>/<repo>/pulls/1/update-branch
+#   by merging the branches in the bare repository, like github does
+#
+# Usage: python -m pastamaker.bench_update_branch [iterations] [commits]
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import github
+from six.moves import BaseHTTPServer
+
+from pastamaker import config
+from pastamaker import gh_pr
+from pastamaker import utils
+
+BASE = "upstream/repo"
+HEAD = "fork/repo"
+HEAD_REF = "feature"
+
+
+def git(cwd, *args):
+    return subprocess.check_output(["git"] + list(args), cwd=cwd,
+                                   stderr=subprocess.STDOUT).strip()
+
+
+def commit(cwd, name):
+    with open(os.path.join(cwd, name), "w") as f:
+        f.write(name)
+    git(cwd, "add", name)
+    git(cwd, "commit", "-q", "-m", name)
+
+
+def setup_repositories(root, commits):
+    work = os.path.join(root, "work")
+    git(root, "init", "-q", work)
+    for i in range(commits):
+        commit(work, "base-%d" % i)
+    git(work, "branch", "-M", "master")
+
+    base_path = os.path.join(root, "github", BASE + ".git")
+    head_path = os.path.join(root, "github", HEAD + ".git")
+    git(root, "clone", "-q", "--bare", work, base_path)
+    # NOTE: forks share the objects of their parent on github
+    git(root, "clone", "-q", "--bare", "--shared", base_path, head_path)
+    # The head repository url has no .git suffix in update_branch()
+    os.symlink(head_path, head_path[:-4])
+
+    git(work, "checkout", "-q", "-b", HEAD_REF)
+    commit(work, "feature")
+    git(work, "push", "-q", head_path, HEAD_REF)
+
+    git(work, "checkout", "-q", "master")
+    commit(work, "base-new")
+    git(work, "push", "-q", base_path, "master")
+    git(head_path, "fetch", "-q", base_path, "master:master")
+    return base_path, head_path, git(head_path, "rev-parse", HEAD_REF)
+
+
+class UpdateBranchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    head_path = None
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.head_path
+        try:
+            tree = git(path, "merge-tree", "--write-tree", HEAD_REF, "master")
+            sha = git(path, "commit-tree", tree.split()[0],
+                      "-p", HEAD_REF, "-p", "master",
+                      "-m", "Merge branch 'master' into '%s'" % HEAD_REF)
+            git(path, "update-ref", "refs/heads/%s" % HEAD_REF, sha)
+        except subprocess.CalledProcessError:
+            status, body = 422, {"message": "merge conflict"}
+        else:
+            status, body = 202, {"message": "Updating pull request branch."}
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def get_pull(url):
+    try:
+        # NOTE: Don't measure the throttling of recent PyGithub
+        g = github.Github("token", base_url=url, seconds_between_requests=0,
+                          seconds_between_writes=0)
+    except TypeError:
+        g = github.Github("token", base_url=url)
+    return github.PullRequest.PullRequest(g._Github__requester, {}, {
+        "number": 1,
+        "url": "%s/repos/%s/pulls/1" % (url, BASE),
+        "state": "open",
+        "commits": 1,
+        "head": {"ref": HEAD_REF, "sha": None,
+                 "repo": {"full_name": HEAD}},
+        "base": {"ref": "master", "sha": None,
+                 "user": {"login": BASE.split("/")[0]},
+                 "repo": {"name": BASE.split("/")[1], "full_name": BASE}},
+    }, completed=True)
+
+
+def bench(strategy, pull, head_path, head_sha, iterations):
+    timings = []
+    for _ in range(iterations):
+        git(head_path, "update-ref", "refs/heads/%s" % HEAD_REF, head_sha)
+        start = time.time()
+        if not pull.pastamaker_update_branch("token", strategy=strategy):
+            raise RuntimeError("%s strategy failed" % strategy)
+        timings.append(time.time() - start)
+    return timings
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    commits = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    utils.setup_logging()
+    gh_pr.monkeypatch_github()
+
+    root = tempfile.mkdtemp(prefix="pastamaker-bench")
+    server = None
+    try:
+        os.environ["HOME"] = root
+        git(root, "config", "--global", "user.name", "bench")
+        git(root, "config", "--global", "user.email", "bench@example.com")
+        git(root, "config", "--global",
+            "url.file://%s/github/.insteadOf" % root,
+            "https://token@github.com/")
+        config.GIT_MIRRORS_DIR = os.path.join(root, "mirrors")
+
+        base_path, head_path, head_sha = setup_repositories(root, commits)
+
+        UpdateBranchHandler.head_path = head_path
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                           UpdateBranchHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        pull = get_pull("http://127.0.0.1:%d" % server.server_port)
+
+        for strategy in ["git", "api"]:
+            timings = bench(strategy, pull, head_path, head_sha, iterations)
+            print("%s: first %.3fs, next ones %.3fs on average" % (
+                strategy, timings[0],
+                sum(timings[1:]) / max(1, len(timings) - 1)))
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,16 +17,28 @@
 
 import sys
 
-import lz4
+import ujson
 
+from pastamaker import storage
 from pastamaker import utils
 
+r = utils.get_redis()
+
+if len(sys.argv) < 2:
+    for queue in storage.get_queues(r):
+        print("%s/%s/%s" % queue)
+    sys.exit(0)
+
 owner, _, left = sys.argv[1].partition("/")
 repo, _, branch = left.partition("/")
 
-key = "queues~%s~%s~%s" % (owner, repo, branch)
-data = utils.get_redis().get(key)
-if data:
-    print(lz4.block.decompress(data))
+if not branch:
+    for branch in storage.get_branches(r, owner, repo):
+        print("%s/%s/%s" % (owner, repo, branch))
+    sys.exit(0)
+
+pulls = storage.load_queue(r, owner, repo, branch)
+if pulls:
+    print(ujson.dumps(pulls))
 else:
     print("no cache")
@@ -15,17 +15,22 @@
 # under the License.
 
 import logging
-import operator
-
+import time
 
 from concurrent import futures
 import github
-import lz4.block
-import ujson
+import rq
+import rq.exceptions
+import rq.job
 
 from pastamaker import config
 from pastamaker import gh_branch  # noqa
 from pastamaker import gh_pr
+from pastamaker import gh_pr_fullifier
+from pastamaker import gh_train
+from pastamaker import gh_update_branch
+from pastamaker import scheduler
+from pastamaker import storage
 from pastamaker import utils
 
 LOG = logging.getLogger(__name__)
@@ -45,22 +50,46 @@ class PastaMakerEngine(object):
 
     def handle(self, event_type, data):
         # Everything start here
+        self.handle_events([(event_type, data)])
+
+    def handle_events(self, events):
+        """Handle events of the same pull request at once
+
+        Events are given in their reception order, the cache invalidations of
+        all of them are merged, so the queue is computed only once.
+        """
 
+        # NOTE: Status of merge trains are handled apart, before dropping the
+        # ones of travis push builds
+        event_type, data = events[-1]
         if event_type == "status":
-            # Don't compute the queue for nothing
-            if data["context"].startswith("%s/" % config.CONTEXT):
-                return
-            elif data["context"] == "continuous-integration/travis-ci/push":
+            train_branch = storage.get_train_branch(
+                self._redis, self._u.login, self._r.name, data["sha"])
+            if train_branch:
+                with self._get_branch_lock(train_branch):
+                    self.handle_train_status(train_branch, data["sha"])
                 return
 
-        # Get the current pull request
-        incoming_pull = gh_pr.from_event(self._r, data)
-        if not incoming_pull:
+        # Don't compute the queue for nothing
+        events = [(event_type, data) for event_type, data in events
+                  if not self._is_useless_status(event_type, data)]
+        if not events:
+            return
+
+        event_type, data = events[-1]
+
+        # Get the current pull request, the most recent payload first
+        for _, event_data in reversed(events):
+            incoming_pull = gh_pr.from_event(self._r, event_data)
+            if incoming_pull:
+                break
+        else:
             if event_type == "status":
                 # It's safe to take the one from cache, since only status have
                 # changed
                 incoming_pull = self.get_incoming_pull_from_cache(data["sha"])
                 if not incoming_pull:
+                    # Pull request never seen by pastamaker
                     issues = list(self._g.search_issues("is:pr %s" %
                                                         data["sha"]))
                     if len(issues) >= 1:
@@ -69,6 +98,9 @@ class PastaMakerEngine(object):
             elif (event_type == "refresh" and
                   data["refresh_ref"].startswith("pull/")):
                 incoming_pull = self._r.get_pull(int(data["refresh_ref"][5:]))
+            elif event_type in ["mergeable_state", "branch_updated",
+                                "proceed"]:
+                incoming_pull = self._r.get_pull(data["number"])
 
         # Get the current branch
         current_branch = None
@@ -82,23 +114,27 @@ class PastaMakerEngine(object):
             return
 
         # Log the event
-        self.log_formated_event(event_type, incoming_pull, data)
+        for event_type, data in events:
+            self.log_formated_event(event_type, incoming_pull, data)
 
-        # Unhandled and already logged
-        if event_type not in ["pull_request", "pull_request_review",
-                              "status", "refresh"]:
-            LOG.info("No need to proceed queue (unwanted event_type)")
+        events = [(event_type, data) for event_type, data in events
+                  if self._is_event_wanted(event_type, data, incoming_pull)]
+        if not events:
             return
 
-        if event_type == "status" and incoming_pull.head.sha != data["sha"]:
-            LOG.info("No need to proceed queue (got status of an old commit)")
-            return
+        # NOTE: All events of a branch must be handled one after the other,
+        # whatever the worker that got them
+        with self._get_branch_lock(current_branch):
+            self._handle_branch_events(current_branch, incoming_pull, events)
 
-        # We don't care about *labeled/*assigned/review_request*/edited
-        if (event_type == "pull_request" and data["action"] not in [
-                "opened", "reopened", "closed", "synchronize", "edited"]):
-            LOG.info("No need to proceed queue (unwanted pull_request action)")
-            return
+    def _get_branch_lock(self, branch):
+        return self._redis.lock("lock~%s~%s~%s" % (self._u.login,
+                                                   self._r.name, branch),
+                                timeout=config.BRANCH_LOCK_TIMEOUT)
+
+    def _handle_branch_events(self, current_branch, incoming_pull, events):
+        event_type, data = events[-1]
+        event_types = set(event_type for event_type, _ in events)
 
         try:
             branch_policy_error = None
@@ -110,91 +146,62 @@ class PastaMakerEngine(object):
 
         fullify_extra = {
             "branch_policy": branch_policy,
-            "collaborators": [u.id for u in self._r.get_collaborators()]
+            "collaborators": self.get_collaborators(),
         }
 
-        if (event_type == "status" and
-                data["context"] == "continuous-integration/travis-ci/pr"):
-            fullify_extra["travis"] = data
-
-        # Retrieve cache
-        cached_pulls = self.load_cache(current_branch)
+        for event_type, data in events:
+            if (event_type == "status" and data["context"] ==
+                    "continuous-integration/travis-ci/pr"):
+                fullify_extra["travis"] = data
 
         # Gather missing github/travis information and compute weight
         if incoming_pull:
             # First, remove informations we don't want to get from cache
-            if event_type == "refresh":
+            if "refresh" in event_types:
                 cache = {}
             else:
-                cache = self.get_cache_for_pull(cached_pulls,
+                cache = self.get_cache_for_pull(current_branch,
                                                 incoming_pull.number)
                 cache = dict((k, v) for k, v in cache.items()
                              if k.startswith("pastamaker_"))
                 cache.pop("pastamaker_weight", None)
 
-                if (event_type == "status" and
-                        data["state"] == cache.get("pastamaker_travis_state")):
-                    LOG.info("No need to proceed queue (got status without "
-                             "state change '%s')" % data["state"])
+                events = [(event_type, data) for event_type, data in events
+                          if self._invalidate_cache(cache, event_type, data)]
+                if not events:
                     return
-                elif event_type == "status":
-                    cache.pop("pastamaker_combined_status", None)
-                    cache["pastamaker_ci_statuses"] = {}
-                    cache["pastamaker_travis_state"] = data["state"]
-                    cache["pastamaker_travis_url"] = data["target_url"]
-                    if data["state"] in ENDING_STATES:
-                        cache.pop("pastamaker_travis_detail", None)
-                    else:
-                        cache["pastamaker_travis_detail"] = {}
-
-                elif event_type == "pull_request_review":
-                    cache.pop("pastamaker_reviews", None)
-                    cache.pop("pastamaker_approvals", None)
-                    cache.pop("pastamaker_approved", None)
-                elif event_type == "pull_request":
-                    if data["action"] not in ["closed", "edited"]:
-                        cache.pop("pastamaker_commits", None)
-                    if data["action"] == "synchronize":
-                        # NOTE(sileht): hardcode ci status that will be refresh
-                        # on next travis event
-                        cache.pop("pastamaker_combined_status", None)
-                        cache["pastamaker_ci_statuses"] = {}
-                        cache.pop("pastamaker_travis_state", None)
-                        cache.pop("pastamaker_travis_url", None)
-                        cache.pop("pastamaker_travis_detail", None)
 
             incoming_pull = incoming_pull.fullify(cache, **fullify_extra)
+            self.handle_branch_update_events(incoming_pull, events)
 
         # NOTE(sileht): just refresh this pull request in cache
-        if event_type == "status" and data["state"] == "pending":
-            self.build_queue_and_save_to_cache(cached_pulls, current_branch,
-                                               incoming_pull)
-            LOG.info("Just update cache (ci status pending)")
-            return
-        elif event_type == "pull_request" and data["action"] == "edited":
-            self.build_queue_and_save_to_cache(cached_pulls, current_branch,
-                                               incoming_pull)
-            LOG.info("Just update cache (pull_request edited)")
-            return
-        elif (event_type == "pull_request_review" and
-                data["review"]["user"]["id"] not in
-                fullify_extra["collaborators"]):
-            self.build_queue_and_save_to_cache(cached_pulls, current_branch,
-                                               incoming_pull)
-            LOG.info("Just update cache (pull_request_review non-collab)")
+        reasons = [self._get_cache_only_reason(event_type, data,
+                                               fullify_extra)
+                   for event_type, data in events]
+        if all(reasons):
+            self.save_pull_to_cache(current_branch, incoming_pull)
+            LOG.info("Just update cache (%s)", ", ".join(set(reasons)))
             return
 
         # NOTE(sileht): We check the state of incoming_pull and the event
         # because user can have restart a travis job between the event
         # received and when we looks at it with travis API
-        if (event_type == "status"
-                and data["state"] in ENDING_STATES
-                and data["context"] in ["continuous-integration/travis-ci",
-                                        "continuous-integration/travis-ci/pr"]
+        if (any(self._is_travis_build_end(event_type, data)
+                for event_type, data in events)
                 and incoming_pull.pastamaker["travis_state"] in ENDING_STATES
                 and incoming_pull.pastamaker["travis_detail"]):
             incoming_pull.pastamaker_travis_post_build_results()
 
+        train = None
+        if branch_policy:
+            train = gh_branch.get_merge_train(self._r)
+            if train and (branch_policy["required_status_checks"] or
+                          {}).get("strict"):
+                LOG.warning("%s, merge train disabled, it requires non "
+                            "strict status checks",
+                            self._get_logprefix(current_branch))
+                train = None
+
         # NOTE(sileht): PullRequest updated or comment posted, maybe we need to
         # update github
         # Get and refresh the queues
@@ -210,14 +217,19 @@ class PastaMakerEngine(object):
                 LOG.warning("FIXME: We got a event without incoming_pull:"
                             "%s : %s" % (event_type, data))
         else:
-            if event_type in ["pull_request", "pull_request_review",
-                              "refresh"]:
+            if event_types & set(["pull_request", "pull_request_review",
+                                  "refresh"]):
                 incoming_pull.pastamaker_github_post_check_status(
                     self._installation_id, self._updater_token,
                     branch_policy_error)
-            queues = self.build_queue_and_save_to_cache(cached_pulls,
-                                                        current_branch,
-                                                        incoming_pull)
+            queues = self.build_queue_and_save_to_cache(
+                current_branch, incoming_pull, train["size"] if train else 1)
+
+        pulls = list(queues)
+        if (incoming_pull and incoming_pull.state == "open" and
+                incoming_pull.number not in [p.number for p in pulls]):
+            pulls.append(incoming_pull)
+        self.schedule_mergeable_state_checks(current_branch, pulls, events)
 
         # Proceed the queue
         if branch_policy and queues:
@@ -228,12 +240,104 @@ class PastaMakerEngine(object):
             except github.UnknownObjectException:
                 LOG.exception("Fail to protect branch, disabled automerge")
                 return
-            self.proceed_queues(queues)
+
+            if not (train and self.proceed_train(current_branch, queues,
+                                                 train["size"])):
+                self.proceed_queues(queues)
         elif not branch_policy:
             LOG.info("No policies setuped, skipping queues processing")
         else:
             LOG.info("Nothing queued, skipping queues processing")
 
+    @staticmethod
+    def _is_useless_status(event_type, data):
+        return event_type == "status" and (
+            data["context"].startswith("%s/" % config.CONTEXT) or
+            data["context"] == "continuous-integration/travis-ci/push")
+
+    @staticmethod
+    def _is_event_wanted(event_type, data, incoming_pull):
+        # Unhandled and already logged
+        if event_type not in ["pull_request", "pull_request_review",
+                              "status", "refresh", "mergeable_state",
+                              "branch_updated", "proceed"]:
+            LOG.info("No need to proceed queue (unwanted event_type)")
+            return False
+
+        if event_type == "status" and incoming_pull.head.sha != data["sha"]:
+            LOG.info("No need to proceed queue (got status of an old commit)")
+            return False
+
+        # We don't care about *labeled/*assigned/review_request*/edited
+        if (event_type == "pull_request" and data["action"] not in [
+                "opened", "reopened", "closed", "synchronize", "edited"]):
+            LOG.info("No need to proceed queue (unwanted pull_request action)")
+            return False
+
+        return True
+
+    @staticmethod
+    def _invalidate_cache(cache, event_type, data):
+        """Remove from cache what this event have changed
+
+        Returns False if the event doesn't change anything.
+        """
+        if (event_type == "status" and
+                data["state"] == cache.get("pastamaker_travis_state")):
+            LOG.info("No need to proceed queue (got status without "
+                     "state change '%s')" % data["state"])
+            return False
+        elif event_type == "status":
+            cache.pop("pastamaker_combined_status", None)
+            cache["pastamaker_ci_statuses"] = {}
+            cache["pastamaker_travis_state"] = data["state"]
+            cache["pastamaker_travis_url"] = data["target_url"]
+            if data["state"] in ENDING_STATES:
+                cache.pop("pastamaker_travis_detail", None)
+            else:
+                cache["pastamaker_travis_detail"] = {}
+                if data["target_url"]:
+                    gh_pr_fullifier.forget_travis_build(
+                        gh_pr_fullifier.get_travis_build_id(
+                            data["target_url"]))
+
+        elif event_type == "pull_request_review":
+            cache.pop("pastamaker_reviews", None)
+            cache.pop("pastamaker_approvals", None)
+            cache.pop("pastamaker_approved", None)
+        elif event_type == "pull_request":
+            if data["action"] not in ["closed", "edited"]:
+                cache.pop("pastamaker_commits", None)
+            if data["action"] == "synchronize":
+                # NOTE(sileht): hardcode ci status that will be refresh
+                # on next travis event
+                cache.pop("pastamaker_combined_status", None)
+                cache["pastamaker_ci_statuses"] = {}
+                cache.pop("pastamaker_travis_state", None)
+                cache.pop("pastamaker_travis_url", None)
+                cache.pop("pastamaker_travis_detail", None)
+        return True
+
+    @staticmethod
+    def _get_cache_only_reason(event_type, data, fullify_extra):
+        if event_type == "status" and data["state"] == "pending":
+            return "ci status pending"
+        elif event_type == "pull_request" and data["action"] == "edited":
+            return "pull_request edited"
+        elif (event_type == "pull_request_review" and
+                data["review"]["user"]["id"] not in
+                fullify_extra["collaborators"]):
+            return "pull_request_review non-collab"
+        elif event_type == "branch_updated" and data["updated"]:
+            return "branch updated, waiting synchronize"
+
+    @staticmethod
+    def _is_travis_build_end(event_type, data):
+        return (event_type == "status"
+                and data["state"] in ENDING_STATES
+                and data["context"] in ["continuous-integration/travis-ci",
+                                        "continuous-integration/travis-ci/pr"])
+
     ###########################
     # State machine goes here #
     ###########################
@@ -244,7 +348,7 @@ class PastaMakerEngine(object):
         'p' is the top priority pull request to merge
         """
 
-        p = queues[0]
+        p = self.get_pull_from_queue(queues[0])
         LOG.info("%s selected", p.pretty())
 
         if p.pastamaker_weight >= 11:
@@ -253,89 +357,338 @@ class PastaMakerEngine(object):
                 LOG.info("%s -> merged", p.pretty())
             else:
                 LOG.info("%s -> merge fail", p.pretty())
+                self._redis.setex(storage.get_merge_failure_key(
+                    self._u.login, self._r.name, p.number, p.head.sha),
+                    storage.MERGE_FAILURE_TTL, "failed")
 
         elif p.mergeable_state == "behind":
             if p.pastamaker["combined_status"] == "success":
                 # rebase it and wait the next pull_request event
                 # (synchronize)
-                if p.pastamaker_update_branch(self._updater_token):
-                    LOG.info("%s -> branch updated", p.pretty())
-                else:
+                if self._redis.exists(gh_update_branch.get_failure_key(
+                        self._u.login, self._r.name, p.number, p.head.sha)):
                     LOG.info("%s -> branch not updatable, "
                              "manual intervention required", p.pretty())
+                elif self.enqueue_branch_update(p):
+                    LOG.info("%s -> branch update queued", p.pretty())
+                else:
+                    LOG.info("%s -> branch update in progress", p.pretty())
             else:
                 LOG.info("%s -> github combined status != success", p.pretty())
 
         else:
             LOG.info("%s -> weight < 10", p.pretty())
 
+    def _get_branch_update_job(self, number):
+        try:
+            return rq.job.Job.fetch(gh_update_branch.get_job_id(
+                self._u.login, self._r.name, number), connection=self._redis)
+        except rq.exceptions.NoSuchJobError:
+            return None
+
+    def enqueue_branch_update(self, p):
+        """Ask the branch updaters to update this pull request
+
+        Returns False if an update of this pull request is already queued or
+        running.
+        """
+        job = self._get_branch_update_job(p.number)
+        if job is not None and job.get_status() in ["queued", "started"]:
+            return False
+        queue = rq.Queue(gh_update_branch.RQ_QUEUE, connection=self._redis)
+        queue.enqueue_call("pastamaker.worker.branch_update_handler",
+                           args=(self._installation_id, self._u.login,
+                                 self._r.name, p.base.ref, p.number,
+                                 p.head.sha),
+                           timeout=config.BRANCH_UPDATE_TIMEOUT,
+                           job_id=gh_update_branch.get_job_id(
+                               self._u.login, self._r.name, p.number))
+        self._redis.publish("rq-update", "noop")
+        return True
+
+    def handle_branch_update_events(self, pull, events):
+        for event_type, data in events:
+            if event_type == "branch_updated" and not data["updated"]:
+                # NOTE: Don't retry until the pull request changes
+                self._redis.setex(gh_update_branch.get_failure_key(
+                    self._u.login, self._r.name, pull.number, data["sha"]),
+                    gh_update_branch.FAILURE_TTL, "failed")
+            elif (event_type == "pull_request" and
+                    data["action"] in ["closed", "synchronize"]):
+                job = self._get_branch_update_job(pull.number)
+                if job is not None and job.get_status() == "queued":
+                    LOG.info("%s, cancelling branch update", pull.pretty())
+                    job.cancel()
+
+    def schedule_mergeable_state_checks(self, branch, pulls, events):
+        """Check again later pulls with a mergeable_state not yet computed
+
+        Instead of waiting for github, a mergeable_state event is sent to
+        ourself, with an exponential backoff between attempts.
+        """
+        attempts = {}
+        for event_type, data in events:
+            if event_type == "mergeable_state":
+                attempts[data["number"]] = data["attempt"]
+                self._redis.delete(self._get_mergeable_state_key(
+                    data["number"]))
+
+        for p in pulls:
+            if not gh_pr_fullifier.is_mergeable_state_pending(p):
+                continue
+            attempt = attempts.get(p.number, 0)
+            if attempt >= config.MERGEABLE_STATE_RETRIES:
+                LOG.warning("%s, mergeable_state still unknown after %d "
+                            "attempts", p.pretty(), attempt)
+                continue
+
+            delay = config.MERGEABLE_STATE_RETRY_DELAY * 2 ** attempt
+            # NOTE: Only one check at a time per pull request
+            if not self._redis.set(self._get_mergeable_state_key(p.number),
+                                   attempt, ex=int(delay * 2), nx=True):
+                continue
+            LOG.info("%s, mergeable_state unknown, checking it in %s sec",
+                     p.pretty(), delay)
+            data = {
+                "installation": {"id": self._installation_id},
+                "repository": {"name": self._r.name,
+                               "owner": {"login": self._u.login}},
+                "branch": branch,
+                "number": p.number,
+                "attempt": attempt + 1,
+            }
+            scheduler.enqueue_at(self._redis, time.time() + delay,
+                                 "pastamaker.worker.deferred_event_handler",
+                                 [("mergeable_state", data)])
+
+    def _get_mergeable_state_key(self, number):
+        return "mergeable-state~%s~%s~%s" % (self._u.login, self._r.name,
+                                             number)
+
+    @staticmethod
+    def _is_train_candidate(p):
+        return (p.pastamaker["approved"] and
+                p.pastamaker["combined_status"] == "success" and
+                p.mergeable_state in ["clean", "unstable", "behind"])
+
+    def _get_train_failure_key(self, number, sha):
+        return "train-failed~%s~%s~%s~%s" % (self._u.login, self._r.name,
+                                             number, sha)
+
+    def _get_train_no_ci_key(self, branch):
+        return "train-no-ci~%s~%s~%s" % (self._u.login, self._r.name, branch)
+
+    def _is_train_without_ci(self, train):
+        return (time.time() - train.get("started_at", time.time()) >
+                config.MERGE_TRAIN_STATUS_TIMEOUT and
+                self._r.get_commit(train["sha"]).get_combined_status()
+                .total_count == 0)
+
+    def proceed_train(self, branch, queues, size):
+        """Merge the ready pull requests of the queue by batch
+
+        Returns False if the queue must be proceeded one by one, when less
+        than two pull requests are ready or the CI doesn't build trains.
+        """
+        if self._redis.exists(self._get_train_no_ci_key(branch)):
+            return False
+
+        train = storage.load_train(self._redis, self._u.login, self._r.name,
+                                   branch)
+        if train and self._is_train_without_ci(train):
+            LOG.warning("%s, train %s has no CI status, merge trains "
+                        "disabled, the CI must build %s",
+                        self._get_logprefix(branch), train["sha"],
+                        gh_train.get_ref(branch))
+            storage.delete_train(self._redis, self._u.login, self._r.name,
+                                 branch, train)
+            gh_train.delete(self._r, branch)
+            self._redis.setex(self._get_train_no_ci_key(branch),
+                              gh_train.NO_CI_TTL, train["sha"])
+            return False
+
+        if train:
+            pulls = dict((p.number, p.head.sha) for p in queues)
+            for t in train["pulls"]:
+                # NOTE: Only the head of the queue is loaded
+                sha = pulls.get(t["number"])
+                if sha is None:
+                    sha = self.get_cache_for_pull(
+                        branch, t["number"]).get("head", {}).get("sha")
+                if sha != t["sha"]:
+                    LOG.info("%s, train %s cancelled, #%s has changed",
+                             self._get_logprefix(branch), train["sha"],
+                             t["number"])
+                    storage.delete_train(self._redis, self._u.login,
+                                         self._r.name, branch, train)
+                    break
+            else:
+                LOG.info("%s, train %s in progress with %s",
+                         self._get_logprefix(branch), train["sha"],
+                         [t["number"] for t in train["pulls"]])
+                return True
+
+        candidates = []
+        for p in queues:
+            # NOTE: Keep the queue order, stop at the first not ready
+            if not self._is_train_candidate(p):
+                break
+            if self._redis.exists(self._get_train_failure_key(p.number,
+                                                              p.head.sha)):
+                LOG.info("%s, broke a previous train, skipped", p.pretty())
+                continue
+            candidates.append(p)
+            if len(candidates) >= size:
+                break
+
+        if len(candidates) < 2:
+            if train:
+                # NOTE: The train has been cancelled
+                gh_train.delete(self._r, branch)
+            return False
+        self.start_train(branch, candidates)
+        return True
+
+    def start_train(self, branch, pulls):
+        sha, merged = gh_train.build(self._r, branch, pulls)
+        if not merged:
+            LOG.info("%s, no pull requests can be merged in the train",
+                     self._get_logprefix(branch))
+            gh_train.delete(self._r, branch)
+            return
+        LOG.info("%s, train %s started with %s", self._get_logprefix(branch),
+                 sha, [p.number for p in merged])
+        storage.save_train(self._redis, self._u.login, self._r.name, branch, {
+            "sha": sha,
+            "started_at": time.time(),
+            "pulls": [{"number": p.number, "sha": p.head.sha}
+                      for p in merged],
+        })
+
+    def handle_train_status(self, branch, sha):
+        train = storage.load_train(self._redis, self._u.login, self._r.name,
+                                   branch)
+        if not train or train["sha"] != sha:
+            return
+
+        state = self._r.get_commit(sha).get_combined_status().state
+        LOG.info("%s, train %s is %s", self._get_logprefix(branch), sha,
+                 state)
+        if state == "pending":
+            return
+        storage.delete_train(self._redis, self._u.login, self._r.name,
+                             branch, train)
+        pulls = []
+        for t in train["pulls"]:
+            p = self._r.get_pull(t["number"])
+            if p.state != "open" or p.head.sha != t["sha"]:
+                LOG.info("%s, has changed since the train started",
+                         p.pretty())
+                break
+            pulls.append(p)
+
+        if state == "success":
+            for p in pulls:
+                if p.pastamaker_merge():
+                    LOG.info("%s -> merged by train", p.pretty())
+                else:
+                    LOG.info("%s -> merge fail", p.pretty())
+                    break
+        elif len(train["pulls"]) == 1:
+            LOG.info("%s, breaks the CI, removed from trains",
+                     pulls[0].pretty() if pulls else train["pulls"][0])
+            self._redis.setex(self._get_train_failure_key(
+                train["pulls"][0]["number"], train["pulls"][0]["sha"]),
+                gh_train.FAILURE_TTL, sha)
+        elif pulls:
+            # NOTE: Bisect, the other half goes in the next train, that
+            # reuses the train branch
+            self.start_train(branch, pulls[:len(train["pulls"]) // 2])
+            return
+        gh_train.delete(self._r, branch)
+
     def set_cache_queues(self, branch, raw_pulls):
-        key = "queues~%s~%s~%s" % (self._u.login, self._r.name, branch)
         LOG.info("%s, saving %d pulls to cache (%s)",
                  self._get_logprefix(branch), len(raw_pulls),
                  [p["number"] for p in raw_pulls])
-        if raw_pulls:
-            payload = ujson.dumps(raw_pulls)
-            # payload = lz4.block.compress(payload)
-            self._redis.set(key, payload)
+        storage.save_queue(self._redis, self._installation_id,
+                           self._u.login, self._r.name, branch, raw_pulls)
+        self._publish_update(branch)
+
+    def save_pull_to_cache(self, branch, pull):
+        if pull.state == "open":
+            LOG.info("%s, saving to cache", pull.pretty())
+            storage.save_pull(self._redis, self._installation_id,
+                              self._u.login, self._r.name, branch,
+                              pull.jsonify())
         else:
-            self._redis.delete(key)
-        self._redis.publish("update", key)
-
-    def get_cache_for_pull(self, raw_pulls, number=None, sha=None):
-        for pull in raw_pulls:
-            if sha is not None and pull["head"]["sha"] == sha:
-                return pull
-            if number is not None and pull["number"] == number:
-                return pull
-        return {}
+            LOG.info("%s, removing from cache", pull.pretty())
+            storage.delete_pull(self._redis, self._installation_id,
+                                self._u.login, self._r.name, branch,
+                                pull.number, pull.head.sha)
+        self._publish_update(branch)
+
+    def _publish_update(self, branch):
+        self._redis.publish("update", storage.get_pulls_key(
+            self._u.login, self._r.name, branch))
+
+    def get_collaborators(self):
+        collaborators = storage.load_collaborators(
+            self._redis, self._installation_id, self._u.login, self._r.name)
+        if collaborators is None:
+            collaborators = set(u.id for u in self._r.get_collaborators())
+            storage.save_collaborators(
+                self._redis, self._installation_id, self._u.login,
+                self._r.name, collaborators, config.COLLABORATORS_CACHE_TTL)
+        return collaborators
+
+    def get_cache_for_pull(self, branch, number):
+        return storage.load_pull(self._redis, self._u.login, self._r.name,
+                                 branch, number)
 
     def get_incoming_pull_from_cache(self, sha):
-        for branch in self.get_cached_branches():
-            cached_pulls = self.load_cache(branch)
-            incoming_pull = self.get_cache_for_pull(cached_pulls, sha=sha)
-            if incoming_pull:
-                return gh_pr.from_event(self._r, incoming_pull)
+        pull = storage.load_pull_by_sha(self._redis, self._u.login,
+                                        self._r.name, sha)
+        if pull:
+            return gh_pr.from_event(self._r, {"pull_request": pull})
 
     def get_cached_branches(self):
-        cache_key = "queues~%s~%s~*" % (self._u.login, self._r.name)
-        return [b.split('~')[3] for b in self._redis.keys(cache_key)]
-
-    def load_cache(self, branch):
-        cache_key = "queues~%s~%s~%s" % (self._u.login, self._r.name,
-                                         branch)
-        data = self._redis.get(cache_key)
-        if data:
-            try:
-                return ujson.loads(data)
-            except Exception:
-                # Old format
-                return ujson.loads(lz4.block.decompress(data))
-        else:
-            return []
+        return storage.get_branches(self._redis, self._u.login, self._r.name)
 
-    def build_queue_and_save_to_cache(self, pulls, branch, incoming_pull):
-        LOG.info("%s, load %d pulls from cache (%s)",
-                 incoming_pull.pretty(),
-                 len(pulls),
-                 [p["number"] for p in pulls])
+    def load_cache(self, branch, count=None):
+        return storage.load_queue(self._redis, self._u.login, self._r.name,
+                                  branch, count)
+
+    def build_queue_and_save_to_cache(self, branch, incoming_pull, count):
+        """Save the incoming pull request and return the head of the queue
 
-        pulls = [p for p in pulls if int(p["number"]) != incoming_pull.number]
+        Only the first count pull requests are loaded, redis keeps them
+        ordered.
+        """
+        self.save_pull_to_cache(branch, incoming_pull)
 
-        LOG.info("%s, convert %d pulls from cache (%s)",
+        pulls = [incoming_pull if int(p["number"]) == incoming_pull.number
+                 else gh_pr.QueuedPull(p)
+                 for p in self.load_cache(branch, count)]
+        LOG.info("%s, load %d pulls from cache (%s)",
                  incoming_pull.pretty(),
                  len(pulls),
-                 [p["number"] for p in pulls])
+                 [p.number for p in pulls])
+        return pulls
 
-        with futures.ThreadPoolExecutor(max_workers=config.WORKERS) as tpe:
-            pulls = list(tpe.map(lambda p: gh_pr.from_cache(self._r, p),
-                                 pulls))
+    def get_pull_from_queue(self, p):
+        """Convert a pull request loaded from the cache to a PullRequest"""
+        if not isinstance(p, gh_pr.QueuedPull):
+            return p
 
-        if incoming_pull.state == "open":
-            LOG.info("%s, add #%s to cache", incoming_pull.pretty(),
-                     incoming_pull.number)
-            pulls.append(incoming_pull)
-        return self.sort_save_and_log_queues(branch, pulls)
+        pull = gh_pr.from_cache(self._r, p.raw)
+        # NOTE: Only write it back if github has just computed the
+        # mergeable_state, otherwise it's unchanged
+        if pull.mergeable_state != p.mergeable_state:
+            storage.save_pull(self._redis, self._installation_id,
+                              self._u.login, self._r.name, pull.base.ref,
+                              pull.jsonify())
+        return pull
 
     def get_updated_queues_from_github(self, branch, **extra):
         LOG.info("%s, retrieving pull requests", self._get_logprefix(branch))
@@ -345,13 +698,22 @@ class PastaMakerEngine(object):
         return self.sort_save_and_log_queues(branch, pulls)
 
     def sort_save_and_log_queues(self, branch, pulls):
-        sort_key = operator.attrgetter('pastamaker_weight', 'updated_at')
-        pulls = list(sorted(pulls, key=sort_key, reverse=True))
+        pulls = self.sort_and_log_queues(branch, pulls)
+        raw_queues = [p.jsonify() for p in pulls]
+        self.set_cache_queues(branch, raw_queues)
+        return pulls
+
+    @staticmethod
+    def _get_sort_key(p):
+        # NOTE: PyGithub returns naive or aware datetimes depending on its
+        # version, the iso strings of github compare the same way
+        return p.pastamaker_weight, p.raw_data["updated_at"]
+
+    def sort_and_log_queues(self, branch, pulls):
+        pulls = list(sorted(pulls, key=self._get_sort_key, reverse=True))
         LOG.info("%s, cache content:" % self._get_logprefix(branch))
         for p in pulls:
             LOG.info("%s, sha: %s->%s)", p.pretty(), p.base.sha, p.head.sha)
-        raw_queues = [p.jsonify() for p in pulls]
-        self.set_cache_queues(branch, raw_queues)
         return pulls
 
     def _get_logprefix(self, branch="<unknown>"):
@@ -386,6 +748,18 @@ class PastaMakerEngine(object):
             else:
                 p_info = self._get_logprefix(data["refresh_ref"])
             extra = ""
+
+        elif event_type == "mergeable_state":
+            p_info = incoming_pull.pretty()
+            extra = ", attempt: %d" % data["attempt"]
+
+        elif event_type == "proceed":
+            p_info = incoming_pull.pretty()
+            extra = ", sent by the scheduler"
+
+        elif event_type == "branch_updated":
+            p_info = incoming_pull.pretty()
+            extra = ", updated: %s, sha: %s" % (data["updated"], data["sha"])
         else:
             if incoming_pull:
                 p_info = incoming_pull.pretty()
@@ -396,6 +770,7 @@ class PastaMakerEngine(object):
         LOG.info("***********************************************************")
         LOG.info("%s received event '%s'%s", p_info, event_type, extra)
         if config.LOG_RATELIMIT:
-            rate = self._g.get_rate_limit().rate
+            # NOTE: Got from the headers of the last response, no API call
+            remaining, limit = self._g.rate_limiting
             LOG.info("%s ratelimit: %s/%s, reset at %s", p_info,
-                     rate.remaining, rate.limit, rate.reset)
+                     remaining, limit, self._g.rate_limiting_resettime)
@@ -16,22 +16,28 @@
 
 import collections
 import copy
+import hashlib
 import logging
 import os
 import re
 import sys
 
 import github
+import ujson
 import voluptuous
 import yaml
 
 from pastamaker import config
+from pastamaker import utils
 
 LOG = logging.getLogger(__name__)
 
 with open("default_policy.yml", "r") as f:
     DEFAULT_POLICY = yaml.load(f.read())
 
+# NOTE: blob sha of .mergify.yml -> compiled policies
+COMPILED_POLICIES = {}
+
 
 def dict_merge(dct, merge_dct):
     for k, v in merge_dct.items():
@@ -105,7 +111,16 @@ UserConfigurationSchema = voluptuous.Schema({
     'policies': {
         'default': Policy,
         'branches': {str: Policy},
-    }
+    },
+    # NOTE: How branches of pull requests are updated, "api" asks github
+    # to merge the base branch, and fallbacks to "git" on failure
+    voluptuous.Optional('update_branch', default='git'):
+        voluptuous.Any('git', 'api'),
+    # NOTE: Merge the ready pull requests by batch of this size, this
+    # requires non strict status checks
+    voluptuous.Optional('merge_train', default=None): voluptuous.Any(None, {
+        'size': voluptuous.All(int, voluptuous.Range(min=2)),
+    }),
 })
 
 
@@ -117,42 +132,140 @@ class NoPolicies(Exception):
     pass
 
 
-def get_branch_policy(g_repo, branch):
-    # TODO(sileht): Ensure the file is valid
-    policy = copy.deepcopy(DEFAULT_POLICY)
+def get_policy_cache_key(owner, repo):
+    return "policy~%s~%s" % (owner, repo)
+
+
+def delete_policy_cache(r, owner, repo):
+    r.delete(get_policy_cache_key(owner, repo))
+
+
+def get_configuration(g_repo):
+    """Return the blob sha and the content of .mergify.yml
+
+    They are cached in redis until the file is pushed or policy_cache_ttl
+    expires, sha is None if the file doesn't exist.
+    """
+    r = utils.get_redis()
+    key = get_policy_cache_key(g_repo.owner.login, g_repo.name)
+    configuration = r.get(key)
+    if configuration:
+        return ujson.loads(configuration)
 
     try:
-        content = g_repo.get_contents(".mergify.yml").decoded_content
-        LOG.info("found mergify.yml: %s", content)
+        contents = g_repo.get_contents(".mergify.yml")
+        configuration = {"sha": contents.sha,
+                         "content": contents.decoded_content.decode("utf-8")}
+        LOG.info("found mergify.yml: %s", configuration["content"])
     except github.UnknownObjectException:
+        configuration = {"sha": None, "content": None}
+    r.setex(key, config.POLICY_CACHE_TTL, ujson.dumps(configuration))
+    return configuration
+
+
+def compile_policies(sha, content):
+    if sha not in COMPILED_POLICIES:
+        try:
+            configuration = validate_policy(content)
+            policies = configuration["policies"]
+        except voluptuous.MultipleInvalid as e:
+            COMPILED_POLICIES[sha] = NoPolicies(
+                "Content of .mergify.yml is invalid: %s" % str(e))
+        else:
+            default = copy.deepcopy(DEFAULT_POLICY)
+            dict_merge(default, policies["default"])
+            COMPILED_POLICIES[sha] = {
+                "default": default,
+                "branches": [(re.compile(branch_re), branch_policy)
+                             for branch_re, branch_policy
+                             in policies["branches"].items()],
+                "resolved": {},
+                "update_branch": configuration["update_branch"],
+                "merge_train": configuration["merge_train"],
+            }
+    return COMPILED_POLICIES[sha]
+
+
+def get_policies(g_repo):
+    configuration = get_configuration(g_repo)
+    sha = configuration["sha"]
+    content = configuration["content"]
+
+    if sha is None:
         # NOTE(sileht): Fallback to a local file
         f = "%s_policy.yml" % g_repo.owner.login
         if os.path.exists(f):
             LOG.info("fallback to local %s", f)
             with open(f, "r") as f:
                 content = f.read()
+            # NOTE: local files are only changed by a redeploy
+            sha = "local-%s" % f.name
         else:
             raise NoPolicies(".mergify.yml is missing")
 
+    policies = compile_policies(sha, content)
+    if isinstance(policies, NoPolicies):
+        raise policies
+    return policies
+
+
+def get_update_branch_strategy(g_repo):
     try:
-        policies = validate_policy(content)["policies"]
-    except voluptuous.MultipleInvalid as e:
-        raise NoPolicies("Content of .mergify.yml is invalid: %s" % str(e))
+        return get_policies(g_repo)["update_branch"]
+    except NoPolicies:
+        return "git"
+
+
+def get_merge_train(g_repo):
+    try:
+        return get_policies(g_repo)["merge_train"]
+    except NoPolicies:
+        return None
+
+
+def get_branch_policy(g_repo, branch):
+    policies = get_policies(g_repo)
+    if branch not in policies["resolved"]:
+        policy = copy.deepcopy(policies["default"])
+        for branch_re, branch_policy in policies["branches"]:
+            if branch_re.match(branch):
+                dict_merge(policy, copy.deepcopy(branch_policy))
+        policies["resolved"][branch] = policy
+
+    # NOTE: The caller may modify it
+    return copy.deepcopy(policies["resolved"][branch])
 
-    dict_merge(policy, policies["default"])
 
-    for branch_re in policies["branches"]:
-        if re.match(branch_re, branch):
-            dict_merge(policy, policies["branches"][branch_re])
+def get_protection_cache_key(owner, repo, branch):
+    return "protection~%s~%s~%s" % (owner, repo, branch)
 
-    return policy
+
+def delete_protection_cache(r, owner, repo, branches):
+    keys = [get_protection_cache_key(owner, repo, b) for b in branches]
+    if keys:
+        r.delete(*keys)
 
 
 def protect_if_needed(g_repo, branch, policy):
+    """Protect the branch if it doesn't match the policy
+
+    Once verified, the policy hash is cached until a branch protection rule
+    changes or protection_cache_ttl expires.
+    """
+    r = utils.get_redis()
+    key = get_protection_cache_key(g_repo.owner.login, g_repo.name, branch)
+    policy_hash = hashlib.sha1(ujson.dumps(policy, sort_keys=True)
+                               .encode("utf-8")).hexdigest()
+    if utils.to_str(r.get(key)) == policy_hash:
+        utils.incr_stats(r, "protection_checks_skipped")
+        return
+
     if not is_protected(g_repo, branch, policy):
         LOG.warning("Branch %s of %s is misconfigured, configuring it to %s",
                     branch, g_repo.full_name, policy)
         protect(g_repo, branch, policy)
+    r.setex(key, config.PROTECTION_CACHE_TTL, policy_hash)
+    utils.incr_stats(r, "protection_checks_done")
 
 
 def test():
@@ -0,0 +1,78 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# NOTE: Github doesn't count 304 responses in the rate limit. GET responses
+# are stored in redis with their ETag, and sent again with If-None-Match, so
+# we get the cached response for free when nothing has changed.
+
+import hashlib
+import logging
+
+import github
+import ujson
+
+from pastamaker import config
+from pastamaker import utils
+
+LOG = logging.getLogger(__name__)
+
+CONDITIONAL_HEADERS = ["If-None-Match", "If-Modified-Since"]
+
+global ORIGINAL_REQUEST_JSON
+ORIGINAL_REQUEST_JSON = None
+
+
+def get_cache_key(url, parameters, headers):
+    accept = (headers or {}).get("Accept")
+    payload = ujson.dumps([url, parameters or {}, accept], sort_keys=True)
+    return "etag~%s" % hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def request_json(self, verb, url, parameters=None, headers=None, input=None,
+                 *args, **kwargs):
+    # NOTE: The caller already does its own conditional request
+    if verb != "GET" or any(h in (headers or {}) for h in CONDITIONAL_HEADERS):
+        return ORIGINAL_REQUEST_JSON(self, verb, url, parameters, headers,
+                                     input, *args, **kwargs)
+
+    r = utils.get_redis()
+    key = get_cache_key(url, parameters, headers)
+    cached = r.get(key)
+    if cached:
+        cached = ujson.loads(cached)
+        headers = dict(headers or {})
+        headers["If-None-Match"] = cached["etag"]
+
+    status, response_headers, output = ORIGINAL_REQUEST_JSON(
+        self, verb, url, parameters, headers, input, *args, **kwargs)
+
+    if status == 304 and cached:
+        utils.incr_stats(r, "github_not_modified")
+        return 200, cached["headers"], cached["output"]
+    elif status == 200 and "etag" in response_headers:
+        r.setex(key, config.ETAG_CACHE_TTL, ujson.dumps({
+            "etag": response_headers["etag"],
+            "headers": response_headers,
+            "output": output,
+        }))
+    return status, response_headers, output
+
+
+def monkeypatch_github():
+    global ORIGINAL_REQUEST_JSON
+    if ORIGINAL_REQUEST_JSON is None:
+        ORIGINAL_REQUEST_JSON = github.Requester.Requester.requestJson
+        github.Requester.Requester.requestJson = request_json
@@ -14,6 +14,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import logging
 
 import github
@@ -25,19 +26,20 @@ from pastamaker import gh_update_branch
 LOG = logging.getLogger(__name__)
 
 
-def pretty(self):
-    extra = getattr(self, "pastamaker", {})
+Ref = collections.namedtuple("Ref", ["ref", "sha"])
+
+
+def _pretty(owner, repo, number, ref, state, mergeable_state, extra):
     status = extra.get("combined_status", "nc")
     approvals = len(extra["approvals"][0]) if "approvals" in extra else "nc"
     weight = extra["weight"] if extra.get("weight", -1) >= 0 else "NA"
     synced = extra.get("sync_with_master", "nc")
     return "%s/%s/pull/%s@%s (%s/%s/%s/%s/%s)" % (
-        self.base.user.login,
-        self.base.repo.name,
-        self.number,
-        self.base.ref,
-        ("merged" if self.state == "merged"
-         else (self.mergeable_state or "none")),
+        owner,
+        repo,
+        number,
+        ref,
+        ("merged" if state == "merged" else (mergeable_state or "none")),
         synced,
         status,
         approvals,
@@ -45,6 +47,54 @@ def pretty(self):
     )
 
 
+def pretty(self):
+    return _pretty(self.base.user.login, self.base.repo.name, self.number,
+                   self.base.ref, self.state, self.mergeable_state,
+                   getattr(self, "pastamaker", {}))
+
+
+class QueuedPull(object):
+    """A pull request of a queue loaded from the cache
+
+    Sorting, logging and saving a queue only need the cached data, only the
+    pull request we act on is converted to a PullRequest with from_cache().
+    """
+    __slots__ = ["raw", "number", "state", "mergeable_state", "pastamaker"]
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.number = raw["number"]
+        self.state = raw["state"]
+        self.mergeable_state = raw.get("mergeable_state")
+        self.pastamaker = dict((k[11:], v) for k, v in raw.items()
+                               if k.startswith("pastamaker_"))
+
+    @property
+    def raw_data(self):
+        return self.raw
+
+    @property
+    def pastamaker_weight(self):
+        return self.pastamaker["weight"]
+
+    @property
+    def base(self):
+        return Ref(self.raw["base"]["ref"], self.raw["base"]["sha"])
+
+    @property
+    def head(self):
+        return Ref(self.raw["head"]["ref"], self.raw["head"]["sha"])
+
+    def pretty(self):
+        return _pretty(self.raw["base"]["user"]["login"],
+                       self.raw["base"]["repo"]["name"], self.number,
+                       self.raw["base"]["ref"], self.state,
+                       self.mergeable_state, self.pastamaker)
+
+    def jsonify(self):
+        return self.raw
+
+
 def pastamaker_github_post_check_status(self, installation_id, updater_token,
                                         branch_policy_error):
 
@@ -14,62 +14,173 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import copy
 import logging
 import time
 
+from concurrent import futures
 import github
-import requests
 import six.moves
+import ujson
+
+from pastamaker import config
+from pastamaker import utils
 
 LOG = logging.getLogger(__name__)
 TRAVIS_BASE_URL = 'https://api.travis-ci.org'
 TRAVIS_V2_HEADERS = {"Accept": "application/vnd.travis-ci.2+json",
                      "User-Agent": "Pastamaker/1.0.0"}
 
+# NOTE: builds and jobs can't change anymore once in these states
+TRAVIS_ENDING_STATES = ["passed", "failed", "errored", "canceled"]
+TRAVIS_CACHE_TTL = 7 * 24 * 3600
+
 UNUSABLE_STATES = ["unknown", None]
 
+# NOTE: Only these fields of the github payloads are cached, this is what the
+# engine and the dashboard use. None means the whole value is kept. Anything
+# else can be retrieved on demand with update().
+USER_FIELDS = {"id": None, "login": None, "avatar_url": None,
+               "html_url": None}
+REPO_FIELDS = {"name": None, "full_name": None, "url": None,
+               "owner": {"login": None}}
+PULL_FIELDS = {
+    "id": None,
+    "number": None,
+    "url": None,
+    "html_url": None,
+    "issue_url": None,
+    "title": None,
+    "state": None,
+    "merged": None,
+    "mergeable": None,
+    "mergeable_state": None,
+    "maintainer_can_modify": None,
+    "updated_at": None,
+    "comments": None,
+    "commits": None,
+    "additions": None,
+    "deletions": None,
+    "changed_files": None,
+    "user": USER_FIELDS,
+    "milestone": {"number": None, "title": None, "html_url": None},
+    "head": {"ref": None, "sha": None, "repo": REPO_FIELDS},
+    "base": {"ref": None, "sha": None, "user": USER_FIELDS,
+             "repo": REPO_FIELDS},
+}
+COMMIT_FIELDS = {"sha": None, "commit": {"message": None},
+                 "stats": {"additions": None, "deletions": None}}
+REVIEW_FIELDS = {"id": None, "state": None, "user": USER_FIELDS}
+
+
+def project(data, fields):
+    """Return only the given fields of a github payload"""
+    if isinstance(data, list):
+        return [project(item, fields) for item in data]
+    elif not isinstance(data, dict):
+        return data
+    return dict((key, data[key] if sub_fields is None
+                 else project(data[key], sub_fields))
+                for key, sub_fields in fields.items() if key in data)
+
 
 def ensure_mergable_state(pull):
     if pull.is_merged() or pull.mergeable_state not in UNUSABLE_STATES:
         return pull
 
-    # Github is currently processing this PR, we wait the completion
-    for i in range(0, 5):
-        LOG.info("%s, refreshing...", pull.pretty())
-        pull.update()
-        if pull.is_merged() or pull.mergeable_state not in UNUSABLE_STATES:
-            break
-        time.sleep(0.42)  # you known, this one always work
-
+    # NOTE: Github is currently processing this PR, refresh it only once. If
+    # it's still unknown, the engine checks it again later instead of waiting
+    LOG.info("%s, refreshing...", pull.pretty())
+    pull.update()
     return pull
 
 
+def is_mergeable_state_pending(pull):
+    return pull.state == "open" and pull.mergeable_state in UNUSABLE_STATES
+
+
+def get_travis_job(job_id):
+    key = "travis-job~%s" % job_id
+    job = utils.get_redis().get(key)
+    if job:
+        return ujson.loads(job)
+
+    r = utils.get_http_session().get(TRAVIS_BASE_URL + "/jobs/%s" % job_id,
+                                     headers=TRAVIS_V2_HEADERS)
+    if r.status_code != 200:
+        return None
+    job = r.json()["job"]
+    job["log_url"] = TRAVIS_BASE_URL + "/jobs/%s/log" % job_id
+    if job["state"] in TRAVIS_ENDING_STATES:
+        utils.get_redis().setex(key, TRAVIS_CACHE_TTL, ujson.dumps(job))
+    return job
+
+
+def get_travis_build(build_id):
+    """Return the travis build with all its jobs
+
+    Finished builds are cached, jobs are retrieved concurrently.
+    """
+    key = "travis-build~%s" % build_id
+    build = utils.get_redis().get(key)
+    if build:
+        return ujson.loads(build)
+
+    r = utils.get_http_session().get(TRAVIS_BASE_URL + "/builds/" + build_id,
+                                     headers=TRAVIS_V2_HEADERS)
+    if r.status_code != 200:
+        return None
+    build = r.json()["build"]
+    # NOTE: Finished jobs are cached before their build, index them to
+    # forget them on restart
+    utils.get_redis().setex("travis-build-jobs~%s" % build_id,
+                            TRAVIS_CACHE_TTL, ujson.dumps(build["job_ids"]))
+
+    with futures.ThreadPoolExecutor(max_workers=config.WORKERS) as tpe:
+        jobs = list(tpe.map(get_travis_job, build["job_ids"]))
+    build["jobs"] = [job for job in jobs if job is not None]
+
+    if (build["state"] in TRAVIS_ENDING_STATES and
+            len(build["jobs"]) == len(build["job_ids"]) and
+            all(job["state"] in TRAVIS_ENDING_STATES
+                for job in build["jobs"])):
+        utils.get_redis().setex(key, TRAVIS_CACHE_TTL, ujson.dumps(build))
+    return build
+
+
+def get_travis_build_id(travis_url):
+    return travis_url.split("?")[0].split("/")[-1]
+
+
+def forget_travis_build(build_id):
+    """Remove a build and its finished jobs from the cache
+
+    Restarted builds and jobs keep their ids.
+    """
+    r = utils.get_redis()
+    keys = ["travis-build~%s" % build_id, "travis-build-jobs~%s" % build_id]
+    build, job_ids = r.mget(keys)
+    job_ids = set(ujson.loads(job_ids) if job_ids else [])
+    if build:
+        job_ids.update(ujson.loads(build)["job_ids"])
+    r.delete(*(keys + ["travis-job~%s" % job_id for job_id in job_ids]))
+
+
 def compute_travis_detail(pull, **extra):
     if (not pull.pastamaker["travis_url"] or
             pull.pastamaker["travis_url"] == "#"):
         return None
-    build_id = pull.pastamaker["travis_url"].split("?")[0].split("/")[-1]
-    r = requests.get(TRAVIS_BASE_URL + "/builds/" + build_id,
-                     headers=TRAVIS_V2_HEADERS)
-    if r.status_code != 200:
+    build_id = get_travis_build_id(pull.pastamaker["travis_url"])
+    build = get_travis_build(build_id)
+    if build is None:
         return None
-    build = r.json()["build"]
     build["resume_state"] = pull.pastamaker["travis_state"]
-    build["jobs"] = []
-    for job_id in build["job_ids"]:
-        r = requests.get(TRAVIS_BASE_URL + "/jobs/%s" % job_id,
-                         headers=TRAVIS_V2_HEADERS)
-        if r.status_code == 200:
-            job = r.json()["job"]
-            job["log_url"] = TRAVIS_BASE_URL + "/jobs/%s/log" % job_id
-            LOG.debug("%s: job %s %s -> %s" % (pull.pretty(), job_id,
-                                               job["state"],
-                                               job["log_url"]))
-            build["jobs"].append(job)
-            if (pull.pastamaker["travis_state"] == "pending" and
-                    job["state"] == "started"):
-                build["resume_state"] = "working"
+    for job in build["jobs"]:
+        LOG.debug("%s: job %s %s -> %s" % (pull.pretty(), job["id"],
+                                           job["state"],
+                                           job["log_url"]))
+        if (pull.pastamaker["travis_state"] == "pending" and
+                job["state"] == "started"):
+            build["resume_state"] = "working"
     LOG.debug("%s: build %s %s/%s" % (pull.pretty(), build_id,
                                       build["state"],
                                       build["resume_state"]))
@@ -84,7 +195,8 @@ def compute_approvals(pull, **extra):
         if review.user.id not in extra["collaborators"]:
             continue
 
-        users_info[review.user.login] = review.user.raw_data
+        users_info[review.user.login] = project(review.user.raw_data,
+                                                USER_FIELDS)
         if review.state == 'APPROVED':
             reviews_ok.add(review.user.login)
             if review.user.login in reviews_ko:
@@ -194,33 +306,35 @@ def compute_weight(pull, **extra):
     return weight
 
 
-# Order matter, some method need result of some other
+# Each method is computed once the values it needs are available, methods
+# without dependencies between them are computed concurrently
 FULLIFIER = [
-    ("commits", lambda p, **extra: list(p.get_commits())),
-    ("reviews", lambda p, **extra: list(p.get_reviews())),
-    ("combined_status", compute_combined_status),
-    ("approvals", compute_approvals),          # Need reviews
-    ("approved", compute_approved),            # Need approvals
-    ("ci_statuses", compute_ci_statuses),      # Need approvals
-    ("travis_state", compute_travis_state),    # Need ci_statuses
-    ("travis_url", compute_travis_url),        # Need ci_statuses
-    ("travis_detail", compute_travis_detail),  # Need travis_url
-    ("weight", compute_weight),                # Need approved, travis_state
+    ("commits", lambda p, **extra: list(p.get_commits()), []),
+    ("reviews", lambda p, **extra: list(p.get_reviews()), []),
+    ("combined_status", compute_combined_status, []),
+    ("approvals", compute_approvals, ["reviews"]),
+    ("approved", compute_approved, ["approvals"]),
+    ("ci_statuses", compute_ci_statuses, []),
+    ("travis_state", compute_travis_state, ["ci_statuses"]),
+    ("travis_url", compute_travis_url, ["ci_statuses"]),
+    ("travis_detail", compute_travis_detail, ["travis_state", "travis_url"]),
+    ("weight", compute_weight, ["approved", "combined_status"]),
 ]
 
 CACHE_HOOK_LIST_CONVERT = {
-    "commits": github.Commit.Commit,
-    "reviews": github.PullRequestReview.PullRequestReview,
+    "commits": (github.Commit.Commit, COMMIT_FIELDS),
+    "reviews": (github.PullRequestReview.PullRequestReview, REVIEW_FIELDS),
 }
 
 
 def jsonify(pull):
-    raw = copy.copy(pull.raw_data)
-    for key, method in FULLIFIER:
+    raw = project(pull.raw_data, PULL_FIELDS)
+    for key, _, _ in FULLIFIER:
         value = pull.pastamaker[key]
         if key in CACHE_HOOK_LIST_CONVERT:
+            fields = CACHE_HOOK_LIST_CONVERT[key][1]
             try:
-                value = [item.raw_data for item in value]
+                value = [project(item.raw_data, fields) for item in value]
             except AttributeError:
                 LOG.exception("%s, fail to cache %s: %s",
                               pull.pretty(), key, value)
@@ -229,6 +343,15 @@ def jsonify(pull):
     return raw
 
 
+def _compute(pull, key, method, extra):
+    start = time.time()
+    LOG.info("%s, compute %s" % (pull.pretty(), key))
+    value = method(pull, **extra)
+    LOG.debug("%s, %s computed in %s sec" % (
+        pull.pretty(), key, time.time() - start))
+    return value
+
+
 def fullify(pull, cache=None, **extra):
     LOG.debug("%s, fullifing...", pull.pretty())
     if not hasattr(pull, "pastamaker"):
@@ -236,24 +359,37 @@ def fullify(pull, cache=None, **extra):
 
     pull = ensure_mergable_state(pull)
 
-    for key, method in FULLIFIER:
-        if key not in pull.pastamaker:
-            if cache and "pastamaker_%s" % key in cache:
-                value = cache["pastamaker_%s" % key]
-                klass = CACHE_HOOK_LIST_CONVERT.get(key)
-                if klass:
-                    value = [klass(pull.base.repo._requester, {}, item,
-                                   completed=True) for item in value]
-            elif key == "raw_data":
-                value = method(pull, **extra)
-            else:
-                start = time.time()
-                LOG.info("%s, compute %s" % (pull.pretty(), key))
-                value = method(pull, **extra)
-                LOG.debug("%s, %s computed in %s sec" % (
-                    pull.pretty(), key, time.time() - start))
-
+    missing = []
+    for key, method, dependencies in FULLIFIER:
+        if key in pull.pastamaker:
+            continue
+        elif cache and "pastamaker_%s" % key in cache:
+            value = cache["pastamaker_%s" % key]
+            if key in CACHE_HOOK_LIST_CONVERT:
+                klass = CACHE_HOOK_LIST_CONVERT[key][0]
+                value = [klass(pull.base.repo._requester, {}, item,
+                               completed=True) for item in value]
             pull.pastamaker[key] = value
+        else:
+            missing.append((key, method, dependencies))
+
+    if missing:
+        with futures.ThreadPoolExecutor(max_workers=len(missing)) as tpe:
+            running = {}
+            while missing or running:
+                for item in list(missing):
+                    key, method, dependencies = item
+                    if all(d in pull.pastamaker for d in dependencies):
+                        running[tpe.submit(_compute, pull, key, method,
+                                           extra)] = key
+                        missing.remove(item)
+                if not running:
+                    raise RuntimeError("Unresolvable fullifier dependencies: "
+                                       "%s" % [m[0] for m in missing])
+                done, _ = futures.wait(running,
+                                       return_when=futures.FIRST_COMPLETED)
+                for f in done:
+                    pull.pastamaker[running.pop(f)] = f.result()
 
     LOG.debug("%s, fullified", pull.pretty())
     return pull
@@ -0,0 +1,94 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# NOTE: A merge train is the branch pastamaker/train/<branch>, with
+# the ready pull requests merged on top of <branch>. It's built with the git
+# refs and merges API, so nothing is cloned. If the CI passes on it, all its
+# pull requests are merged, otherwise half of them are tried again, until the
+# pull request that breaks the CI is found.
+#
+# The CI must build the pastamaker/train/* branches. If the head of a train
+# has no status after config.MERGE_TRAIN_STATUS_TIMEOUT, trains are disabled
+# for the branch during NO_CI_TTL, and its pull requests are merged one by
+# one.
+#
+# The train branch is deleted once the train is done or cancelled. When a
+# train times out, its branch is left until the next train of the branch
+# replaces it.
+
+import logging
+
+import github
+
+LOG = logging.getLogger(__name__)
+
+# NOTE: A pull request that breaks the CI of a train is not put in a train
+# again until its head changes or this delay expires
+FAILURE_TTL = 7 * 24 * 3600
+
+NO_CI_TTL = 24 * 3600
+
+
+def get_ref(branch):
+    return "pastamaker/train/%s" % branch
+
+
+def build(g_repo, branch, pulls):
+    """Create the train of branch with the pulls merged on top of it
+
+    Returns the sha of the head of the train and the pull requests merged,
+    the ones that conflict are skipped.
+    """
+    ref = get_ref(branch)
+    sha = g_repo.get_branch(branch).commit.sha
+    try:
+        g_repo._requester.requestJsonAndCheck(
+            "PATCH", g_repo.url + "/git/refs/heads/" + ref,
+            input={"sha": sha, "force": True})
+    except github.GithubException:
+        g_repo._requester.requestJsonAndCheck(
+            "POST", g_repo.url + "/git/refs",
+            input={"ref": "refs/heads/" + ref, "sha": sha})
+
+    merged = []
+    for p in pulls:
+        try:
+            headers, data = g_repo._requester.requestJsonAndCheck(
+                "POST", g_repo.url + "/merges",
+                input={"base": ref,
+                       "head": p.head.sha,
+                       "commit_message": "Merge pull request #%s into %s" % (
+                           p.number, ref)})
+        except github.GithubException as e:
+            if e.status != 409:
+                raise
+            LOG.info("%s, conflicts with the train, skipped", p.pretty())
+            continue
+        # NOTE: No content means it's already merged
+        if data:
+            sha = data["sha"]
+        merged.append(p)
+    return sha, merged
+
+
+def delete(g_repo, branch):
+    try:
+        g_repo._requester.requestJsonAndCheck(
+            "DELETE", g_repo.url + "/git/refs/heads/" + get_ref(branch))
+    except github.GithubException as e:
+        # Already deleted
+        if e.status not in [404, 422]:
+            raise
@@ -14,12 +14,17 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
+import fcntl
+import hashlib
 import logging
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
 import github
 
@@ -29,10 +34,25 @@ LOG = logging.getLogger(__name__)
 
 NULL = open(os.devnull, 'wb')
 
+# NOTE: Branch updates are done by dedicated workers listening on
+# this rq queue, see worker.branch_updater_main()
+RQ_QUEUE = "branch-updates"
+
+# NOTE: A failed update is not retried until the pull request head
+# changes or this delay expires
+FAILURE_TTL = 7 * 24 * 3600
+
+# NOTE: Each base repository has a bare mirror in
+# config.GIT_MIRRORS_DIR, that also gets the branches of the forks. Updates
+# are done in a temporary clone sharing the objects of the mirror (alternates)
+# so only new objects are downloaded. The least recently used mirrors are
+# removed when they take more than config.GIT_MIRRORS_MAX_SIZE MB.
+
 
 class Gitter(object):
-    def __init__(self):
-        self.tmp = tempfile.mkdtemp(prefix="pastamaker-gitter")
+    def __init__(self, path=None):
+        self.temporary = path is None
+        self.tmp = path or tempfile.mkdtemp(prefix="pastamaker-gitter")
         LOG.info("working in: %s" % self.tmp)
 
     def __call__(self, *args, **kwargs):
@@ -40,57 +60,169 @@ class Gitter(object):
         kwargs["cwd"] = self.tmp
         kwargs.setdefault("stdout", NULL)
         p = subprocess.Popen(["git"] + list(args), **kwargs)
-        p.wait()
+        timer = threading.Timer(config.GIT_TIMEOUT, p.kill)
+        timer.start()
+        try:
+            p.wait()
+        finally:
+            timer.cancel()
+            # NOTE: Don't leave git running when the job is interrupted
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, args[0])
         return p
 
     def cleanup(self):
-        LOG.info("cleaning: %s" % self.tmp)
-        shutil.rmtree(self.tmp)
+        if self.temporary:
+            LOG.info("cleaning: %s" % self.tmp)
+            shutil.rmtree(self.tmp)
+
+
+def get_job_id(owner, repo, number):
+    # NOTE: rq job ids can't contain all characters allowed in
+    # owner and repository names
+    slug = "%s/%s/%s" % (owner, repo, number)
+    return "update-branch-%s" % hashlib.sha1(slug.encode("utf-8")).hexdigest()
+
+
+def get_failure_key(owner, repo, number, sha):
+    return "update-branch-failed~%s~%s~%s~%s" % (owner, repo, number, sha)
+
+
+def get_mirror_path(full_name):
+    return os.path.join(config.GIT_MIRRORS_DIR, full_name + ".git")
+
+
+@contextlib.contextmanager
+def mirror_lock(path, blocking=True):
+    with open(path + ".lock", "w") as f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        fcntl.flock(f, flags)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        size += sum(os.lstat(os.path.join(root, f)).st_size for f in files)
+    return size
+
+
+def evict_mirrors(keep):
+    mirrors = []
+    for owner in os.listdir(config.GIT_MIRRORS_DIR):
+        owner_dir = os.path.join(config.GIT_MIRRORS_DIR, owner)
+        for name in os.listdir(owner_dir):
+            path = os.path.join(owner_dir, name)
+            if name.endswith(".git") and path != keep:
+                mirrors.append((os.path.getmtime(path), path))
 
+    total = get_size(keep) + sum(get_size(p) for _, p in mirrors)
+    budget = config.GIT_MIRRORS_MAX_SIZE * 1024 * 1024
+    for _, path in sorted(mirrors):
+        if total <= budget:
+            break
+        try:
+            with mirror_lock(path, blocking=False):
+                size = get_size(path)
+                LOG.info("removing git mirror %s (%d bytes)", path, size)
+                shutil.rmtree(path)
+                total -= size
+        except IOError:
+            # In use
+            continue
+
+
+def update_branch_with_api(self):
+    """Ask github to merge the base branch into the pull request
+
+    Returns False if github can't, on conflicts for example.
+    """
+    try:
+        self._requester.requestJsonAndCheck(
+            "PUT", self.url + "/update-branch",
+            input={"expected_head_sha": self.head.sha},
+            headers={"Accept": "application/vnd.github.lydian-preview+json"})
+    except github.GithubException as e:
+        LOG.info("%s, github can't update the branch: %d, %s",
+                 self.pretty(), e.status, e.data.get("message"))
+        return False
+    return True
+
+
+def update_branch(self, token, merge=True, strategy="git"):
+    if strategy == "api" and merge:
+        if update_branch_with_api(self):
+            return True
+        LOG.info("%s, fallback to git", self.pretty())
 
-def update_branch(self, token, merge=True):
     # NOTE(sileht):
-    # $ curl https://api.github.com/repos/sileht/repotest/pulls/2 | jq .commits
-    # 2
-    # $ git clone https://XXXXX@github.com/sileht-tester/repotest \
-    #           --depth=$((2 + 1)) -b sileht/testpr
+    # $ git init --bare mirror
+    # $ git --git-dir mirror fetch https://XXXXX@github.com/sileht/repotest \
+    #           +refs/heads/master:refs/heads/upstream/master
+    # $ git --git-dir mirror fetch \
+    #           https://XXXXX@github.com/sileht-tester/repotest \
+    #           +refs/heads/sileht/testpr:refs/heads/pull/2
+    # $ git clone --shared -b pull/2 mirror repotest
     # $ cd repotest
-    # $ git remote add upstream https://XXXXX@github.com/sileht/repotest.git
-    # $ git log | grep Date | tail -1
-    # Date:   Fri Mar 30 21:30:26 2018 (10 days ago)
-    # $ git fetch upstream master --shallow-since="Fri Mar 30 21:30:26 2018"
-    # $ git rebase upstream/master
-    # $ git push origin sileht/testpr:sileht/testpr
+    # $ git rebase origin/upstream/master
+    # $ git push https://XXXXX@github.com/sileht-tester/repotest \
+    #           HEAD:sileht/testpr
+
+    mirror_path = get_mirror_path(self.base.repo.full_name)
+    pull_ref = "pull/%s" % self.number
+    upstream_ref = "upstream/%s" % self.base.ref
+    head_url = "https://%s@github.com/%s/" % (token,
+                                              self.head.repo.full_name)
+    base_url = "https://%s@github.com/%s.git" % (token,
+                                                 self.base.repo.full_name)
+
+    if not os.path.exists(os.path.dirname(mirror_path)):
+        os.makedirs(os.path.dirname(mirror_path))
 
     git = Gitter()
     try:
-        git("clone", "--depth=%d" % (int(self.commits) + 1),
-            "-b", self.head.ref,
-            "https://%s@github.com/%s/" % (token, self.head.repo.full_name),
-            ".")
-        git("remote", "add", "upstream",
-            "https://%s@github.com/%s.git" % (token, self.base.repo.full_name))
-        git("config", "user.name", "%s-bot" % config.CONTEXT)
-        git("config", "user.email", "noreply@mergify.io")
-
-        p = git("log", "--pretty='format:%cI'", stdout=subprocess.PIPE)
-        last_commit_date = p.stdout.read().split("\n")[-1]
-
-        git("fetch", "upstream", self.base.ref,
-            "--shallow-since='%s'" % last_commit_date)
-        if merge:
-            git("merge", "upstream/%s" % self.base.ref, "-m",
-                "Merge branch '%s' into '%s'" % (self.base.ref, self.head.ref))
-        else:
-            # TODO(sileht): This will removes approvals, we need to add them
-            # back
-            git("rebase", "upstream/%s" % self.base.ref)
-        git("push", "origin", self.head.ref)
+        with mirror_lock(mirror_path):
+            mirror = Gitter(mirror_path)
+            if not os.path.exists(mirror_path):
+                os.makedirs(mirror_path)
+                mirror("init", "--bare")
+            os.utime(mirror_path, (time.time(), time.time()))
+
+            mirror("fetch", "--no-tags", base_url,
+                   "+refs/heads/%s:refs/heads/%s" % (self.base.ref,
+                                                     upstream_ref))
+            mirror("fetch", "--no-tags", head_url,
+                   "+refs/heads/%s:refs/heads/%s" % (self.head.ref,
+                                                     pull_ref))
+
+            git("clone", "--shared", "-b", pull_ref, mirror_path, ".")
+            git("config", "user.name", "%s-bot" % config.CONTEXT)
+            git("config", "user.email", "noreply@mergify.io")
+            if merge:
+                git("merge", "origin/%s" % upstream_ref, "-m",
+                    "Merge branch '%s' into '%s'" % (self.base.ref,
+                                                     self.head.ref))
+            else:
+                # TODO(sileht): This will removes approvals, we need to add
+                # them back
+                git("rebase", "origin/%s" % upstream_ref)
+            git("push", head_url, "HEAD:%s" % self.head.ref)
     except Exception:
         LOG.exception("git rebase fail")
         return False
     finally:
         git.cleanup()
+
+    try:
+        evict_mirrors(mirror_path)
+    except Exception:
+        LOG.exception("git mirrors eviction fail")
     return True
 
 
@@ -0,0 +1,165 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import logging
+import time
+
+import rq
+import rq.exceptions
+import rq.job
+
+from pastamaker import config
+from pastamaker import gh_update_branch
+from pastamaker import storage
+from pastamaker import utils
+
+LOG = logging.getLogger(__name__)
+
+INTERVAL = 1
+
+# NOTE: Branches with a proceed event in flight are in the proceeding sorted
+# set, scored by the time they are released if the worker never does it.
+PROCEED_TIMEOUT = 600
+
+# NOTE: A queue head is proceeded again only when its sha changes, or after
+# this delay
+PROCEEDED_TTL = 3600
+
+
+def enqueue_at(r, timestamp, func, *args):
+    """Enqueue a job at the given time
+
+    func can be the dotted path of the function, to avoid circular imports.
+    """
+    job = rq.job.Job.create(func, args=args, connection=r)
+    job.save()
+    r.zadd("scheduled-jobs", {job.id: timestamp})
+
+
+def enqueue_scheduled_jobs(r, queue):
+    count = 0
+    for job_id in r.zrangebyscore("scheduled-jobs", 0, time.time()):
+        # NOTE: Only the scheduler that removes it enqueues the job
+        if not r.zrem("scheduled-jobs", job_id):
+            continue
+        try:
+            job = rq.job.Job.fetch(job_id, connection=r)
+        except rq.exceptions.NoSuchJobError:
+            continue
+        queue.enqueue_job(job)
+        count += 1
+    return count
+
+
+def _get_proceeded_key(owner, repo, branch):
+    return "proceeded~%s~%s~%s" % (owner, repo, branch)
+
+
+def get_ready_pull(r, owner, repo, branch):
+    """Return the head of the queue if it can progress
+
+    That's when it can be merged, or when its branch can be updated, and it
+    has not already been tried.
+    """
+    number = storage.get_queue_head(r, owner, repo, branch)
+    if number is None:
+        return None
+    pull = storage.load_pull(r, owner, repo, branch, number)
+    if not pull:
+        return None
+    sha = pull["head"]["sha"]
+    if utils.to_str(r.get(_get_proceeded_key(owner, repo, branch))) == sha:
+        return None
+
+    if pull.get("pastamaker_weight", -1) >= 11:
+        failure_key = storage.get_merge_failure_key(owner, repo, number, sha)
+    elif (pull.get("mergeable_state") == "behind" and
+            pull.get("pastamaker_combined_status") == "success"):
+        failure_key = gh_update_branch.get_failure_key(owner, repo, number,
+                                                       sha)
+    else:
+        return None
+    if not r.exists(failure_key):
+        return pull
+
+
+def release_proceed(r, owner, repo, branch):
+    r.zrem("proceeding", "%s~%s~%s" % (owner, repo, branch))
+
+
+def proceed_ready_queues(r, queue):
+    """Send a proceed event to the branches that can progress
+
+    At most config.PROCEED_CONCURRENCY branches are proceeded at once, one
+    event at a time for each branch. Installations that have less than
+    config.RATELIMIT_RESERVE requests left are skipped.
+    """
+    now = time.time()
+    r.zremrangebyscore("proceeding", 0, now)
+    count = 0
+    for installation_id in storage.get_installations(r):
+        ratelimit = storage.load_ratelimit(r, installation_id)
+        if (ratelimit and ratelimit["reset"] > now and
+                ratelimit["remaining"] < config.RATELIMIT_RESERVE):
+            continue
+
+        for owner, repo, branch in storage.get_installation_queues(
+                r, installation_id):
+            pull = get_ready_pull(r, owner, repo, branch)
+            if pull is None:
+                continue
+            if r.zcard("proceeding") >= config.PROCEED_CONCURRENCY:
+                return count
+            if not r.zadd("proceeding", {"%s~%s~%s" % (owner, repo, branch):
+                                         now + PROCEED_TIMEOUT}, nx=True):
+                # Already in flight
+                continue
+            queue.enqueue("pastamaker.worker.event_handler", "proceed", {
+                "installation": {"id": int(installation_id)},
+                "repository": {"name": repo, "owner": {"login": owner}},
+                "branch": branch,
+                "number": pull["number"],
+            })
+            r.setex(_get_proceeded_key(owner, repo, branch), PROCEEDED_TTL,
+                    pull["head"]["sha"])
+            count += 1
+    return count
+
+
+def main():
+    """Enqueue the jobs scheduled with enqueue_at() when they are due
+
+    And periodically proceed the queues that can progress, without waiting
+    for a github event.
+    """
+    utils.setup_logging()
+    config.log()
+    r = utils.get_redis()
+    queue = rq.Queue(connection=r)
+    last_proceed = 0
+    while True:
+        count = enqueue_scheduled_jobs(r, queue)
+        if time.time() - last_proceed >= config.PROCEED_INTERVAL:
+            last_proceed = time.time()
+            count += proceed_ready_queues(r, queue)
+        if count:
+            r.publish("rq-update", "noop")
+        time.sleep(INTERVAL)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,522 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# NOTE: Each branch queue is stored with two keys:
+#
+# * pulls~<owner>~<repo>~<branch>: a hash of pull number -> pull json
+# * weights~<owner>~<repo>~<branch>: a sorted set of pull number, scored by
+#   weight then updated_at, so the queue order is kept by redis.
+#
+# And each head sha is indexed with sha~<owner>~<repo>~<sha> to find the
+# pull request of a status event without loading any queue.
+#
+# Non empty queues are registered in sets, to list them without KEYS:
+#
+# * installations: installation ids
+# * repos~<installation_id>: <owner>~<repo> of the installation
+# * branches~<owner>~<repo>: branches of the repository
+#
+# The dashboard summaries is a hash of <owner>~<repo>~<branch> -> updated_at
+# of the most recently updated pull request of the queue, kept as a running
+# max by the writers of the queues.
+#
+# Each update increments status-seq, records it in the summary-seqs hash for
+# the branch, and publishes on status-delta the pull request that has
+# changed, or the whole queue when it's replaced, so clients can apply it to
+# the status they have and detect missed updates.
+#
+# The serialized summary of each branch is kept in
+# summary~<owner>~<repo>~<branch> and the whole status in status, both
+# prefixed with the sequence number they have been built from. They are
+# rebuilt on read when it's outdated, once for all readers.
+#
+# The merge train of a branch is stored in train~<owner>~<repo>~<branch>, and
+# its head sha is indexed with train-sha~<owner>~<repo>~<sha> to find it from
+# status events. Both expire after config.MERGE_TRAIN_TIMEOUT.
+#
+# A failed merge of a queue head is recorded in
+# merge-failed~<owner>~<repo>~<number>~<sha>, for MERGE_FAILURE_TTL.
+#
+# Collaborators ids of repositories are cached in collaborators~<installation>
+# hashes, <owner>~<repo> -> {"ids": [...], "expires_at": ...}
+#
+# An event that touches one pull request only reads and writes its own
+# record, the queue ordering is updated in place.
+#
+# Pull requests are encoded with a one byte header giving the format of the
+# payload, FORMAT_JSON or FORMAT_LZ4_JSON when it's bigger than
+# config.CACHE_COMPRESSION_THRESHOLD. Records written before that are plain
+# json, they are rewritten in the new format on their next update.
+
+import calendar
+import logging
+import time
+
+import lz4.block
+import ujson
+
+from pastamaker import config
+from pastamaker import utils
+
+LOG = logging.getLogger(__name__)
+
+# NOTE: updated_at timestamps are far lower than this, so the weight
+# always take precedence in the score
+WEIGHT_FACTOR = 10 ** 10
+
+FORMAT_JSON = b"\x01"
+FORMAT_LZ4_JSON = b"\x02"
+
+# NOTE: Index of old head sha are not removed, they just expire. Status of old
+# commits can still be matched to their pull request this way.
+SHA_INDEX_TTL = 7 * 24 * 3600
+
+# NOTE: Rebuilding the status takes far less than that
+STATUS_LOCK_TIMEOUT = 60
+
+# NOTE: The scheduler doesn't retry a failed merge until the pull request head
+# changes or this delay expires
+MERGE_FAILURE_TTL = 3600
+
+# NOTE: Unregister the branch only if its queue is still empty, and then
+# its repository and installation if nothing remains in them.
+UNREGISTER_SCRIPT = """
+if redis.call("ZCARD", KEYS[1]) ~= 0 then
+    return 0
+end
+redis.call("SREM", KEYS[2], ARGV[1])
+if redis.call("SCARD", KEYS[2]) == 0 then
+    redis.call("SREM", KEYS[3], ARGV[2])
+    if redis.call("SCARD", KEYS[3]) == 0 then
+        redis.call("SREM", KEYS[4], ARGV[3])
+    end
+end
+return 1
+"""
+
+# NOTE: Update the summary of a branch and publish the delta at once, so
+# concurrent writers can't publish deltas out of order. updated_at only grows,
+# unless the whole queue is replaced.
+UPDATE_SUMMARY_SCRIPT = """
+local seq = redis.call("INCR", KEYS[3])
+if redis.call("ZCARD", KEYS[2]) == 0 then
+    redis.call("HDEL", KEYS[1], ARGV[1])
+    redis.call("HDEL", KEYS[4], ARGV[1])
+    redis.call("DEL", KEYS[5])
+else
+    if ARGV[2] ~= "" then
+        local updated_at = redis.call("HGET", KEYS[1], ARGV[1])
+        if ARGV[5] == "1" or not updated_at or ARGV[2] > updated_at then
+            redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+        end
+    end
+    redis.call("HSET", KEYS[4], ARGV[1], seq)
+end
+local updated_at = redis.call("HGET", KEYS[1], ARGV[1])
+if updated_at then
+    updated_at = '"' .. updated_at .. '"'
+else
+    updated_at = "null"
+end
+redis.call("PUBLISH", "status-delta", '{"seq": ' .. seq .. ', "key": ' ..
+           ARGV[3] .. ', "updated_at": ' .. updated_at .. ', ' ..
+           ARGV[4] .. '}')
+"""
+
+
+def _get_key(prefix, owner, repo, branch):
+    return "%s~%s~%s~%s" % (prefix, owner, repo, branch)
+
+
+def get_pulls_key(owner, repo, branch):
+    return _get_key("pulls", owner, repo, branch)
+
+
+def get_weights_key(owner, repo, branch):
+    return _get_key("weights", owner, repo, branch)
+
+
+def get_sha_key(owner, repo, sha):
+    return _get_key("sha", owner, repo, sha)
+
+
+def get_repos_key(installation_id):
+    return "repos~%s" % installation_id
+
+
+def get_branches_key(owner, repo):
+    return "branches~%s~%s" % (owner, repo)
+
+
+def get_merge_failure_key(owner, repo, number, sha):
+    return "merge-failed~%s~%s~%s~%s" % (owner, repo, number, sha)
+
+
+def get_summary_key(key):
+    return "summary~%s" % key
+
+
+def get_collaborators_key(installation_id):
+    return "collaborators~%s" % installation_id
+
+
+def encode_pull(raw_pull):
+    payload = ujson.dumps(raw_pull).encode("utf-8")
+    if len(payload) > config.CACHE_COMPRESSION_THRESHOLD:
+        return FORMAT_LZ4_JSON + lz4.block.compress(payload)
+    return FORMAT_JSON + payload
+
+
+def decode_pull(payload):
+    fmt, data = payload[:1], payload[1:]
+    if fmt == FORMAT_JSON:
+        return ujson.loads(data)
+    elif fmt == FORMAT_LZ4_JSON:
+        return ujson.loads(lz4.block.decompress(data))
+    # Legacy plain json
+    return ujson.loads(payload)
+
+
+def get_score(raw_pull):
+    updated_at = calendar.timegm(time.strptime(raw_pull["updated_at"],
+                                               "%Y-%m-%dT%H:%M:%SZ"))
+    return raw_pull["pastamaker_weight"] * WEIGHT_FACTOR + updated_at
+
+
+def load_pull(r, owner, repo, branch, number):
+    payload = r.hget(get_pulls_key(owner, repo, branch), number)
+    if payload:
+        return decode_pull(payload)
+    return {}
+
+
+def get_sha_index(r, owner, repo, sha):
+    payload = r.get(get_sha_key(owner, repo, sha))
+    if payload:
+        return ujson.loads(payload)
+
+
+def load_pull_by_sha(r, owner, repo, sha):
+    index = get_sha_index(r, owner, repo, sha)
+    if index:
+        return load_pull(r, owner, repo, index["branch"], index["number"])
+    return {}
+
+
+def _index_sha(pipe, owner, repo, branch, raw_pull):
+    pipe.setex(get_sha_key(owner, repo, raw_pull["head"]["sha"]),
+               SHA_INDEX_TTL,
+               ujson.dumps({"branch": branch, "number": raw_pull["number"]}))
+
+
+def get_branches(r, owner, repo):
+    return set(utils.to_str(branch)
+               for branch in r.smembers(get_branches_key(owner, repo)))
+
+
+def get_installations(r):
+    return set(utils.to_str(installation_id)
+               for installation_id in r.smembers("installations"))
+
+
+def get_installation_queues(r, installation_id):
+    """Return the (owner, repo, branch) of non empty queues of an
+    installation"""
+    queues = []
+    for slug in r.smembers(get_repos_key(installation_id)):
+        owner, repo = utils.to_str(slug).split("~")
+        queues.extend((owner, repo, branch)
+                      for branch in get_branches(r, owner, repo))
+    return queues
+
+
+def get_queues(r):
+    """Return the (owner, repo, branch) of all non empty queues"""
+    queues = []
+    for installation_id in get_installations(r):
+        queues.extend(get_installation_queues(r, installation_id))
+    return queues
+
+
+def _register(pipe, installation_id, owner, repo, branch):
+    pipe.sadd("installations", installation_id)
+    pipe.sadd(get_repos_key(installation_id), "%s~%s" % (owner, repo))
+    pipe.sadd(get_branches_key(owner, repo), branch)
+
+
+def _unregister_if_empty(r, pipe, installation_id, owner, repo, branch):
+    r.register_script(UNREGISTER_SCRIPT)(
+        keys=[get_weights_key(owner, repo, branch),
+              get_branches_key(owner, repo),
+              get_repos_key(installation_id),
+              "installations"],
+        args=[branch, "%s~%s" % (owner, repo), installation_id],
+        client=pipe)
+
+
+def load_queue(r, owner, repo, branch, count=None):
+    """Return the pull requests of the queue, in order
+
+    Only the first count pull requests are loaded, if set.
+    """
+    numbers = r.zrevrange(get_weights_key(owner, repo, branch), 0,
+                          -1 if count is None else count - 1)
+    if not numbers:
+        return _migrate_legacy_queue(r, owner, repo, branch)[:count]
+    payloads = r.hmget(get_pulls_key(owner, repo, branch), numbers)
+    # NOTE: a pull can have been removed between the two calls
+    return [decode_pull(p) for p in payloads if p]
+
+
+def get_queue_head(r, owner, repo, branch):
+    """Return the number of the first pull request of the queue"""
+    numbers = r.zrevrange(get_weights_key(owner, repo, branch), 0, 0)
+    if numbers:
+        return int(numbers[0])
+
+
+def save_pull(r, installation_id, owner, repo, branch, raw_pull):
+    pipe = r.pipeline()
+    pipe.hset(get_pulls_key(owner, repo, branch), raw_pull["number"],
+              encode_pull(raw_pull))
+    pipe.zadd(get_weights_key(owner, repo, branch),
+              {raw_pull["number"]: get_score(raw_pull)})
+    _index_sha(pipe, owner, repo, branch, raw_pull)
+    _register(pipe, installation_id, owner, repo, branch)
+    pipe.execute()
+    _update_summary(r, owner, repo, branch, raw_pull["updated_at"],
+                    '"number": %d, "pull": %s' % (raw_pull["number"],
+                                                  ujson.dumps(raw_pull)))
+
+
+def delete_pull(r, installation_id, owner, repo, branch, number, sha):
+    pipe = r.pipeline()
+    pipe.hdel(get_pulls_key(owner, repo, branch), number)
+    pipe.zrem(get_weights_key(owner, repo, branch), number)
+    pipe.delete(get_sha_key(owner, repo, sha))
+    _unregister_if_empty(r, pipe, installation_id, owner, repo, branch)
+    pipe.execute()
+    _update_summary(r, owner, repo, branch, None,
+                    '"number": %d, "pull": null' % int(number))
+
+
+def save_queue(r, installation_id, owner, repo, branch, raw_pulls):
+    pulls_key = get_pulls_key(owner, repo, branch)
+    weights_key = get_weights_key(owner, repo, branch)
+    pipe = r.pipeline()
+    pipe.delete(pulls_key, weights_key)
+    if raw_pulls:
+        pipe.hmset(pulls_key, dict((p["number"], encode_pull(p))
+                                   for p in raw_pulls))
+        pipe.zadd(weights_key, dict((p["number"], get_score(p))
+                                    for p in raw_pulls))
+        for p in raw_pulls:
+            _index_sha(pipe, owner, repo, branch, p)
+        # NOTE: legacy queues are migrated without installation id, they are
+        # registered on their next write
+        if installation_id is not None:
+            _register(pipe, installation_id, owner, repo, branch)
+    elif installation_id is not None:
+        _unregister_if_empty(r, pipe, installation_id, owner, repo, branch)
+    pipe.execute()
+    _update_summary(r, owner, repo, branch,
+                    max(p["updated_at"] for p in raw_pulls)
+                    if raw_pulls else None,
+                    '"pulls": %s' % ujson.dumps(raw_pulls), replace=True)
+
+
+def _update_summary(r, owner, repo, branch, updated_at, delta,
+                    replace=False):
+    """Update the dashboard summary of the branch and publish the delta"""
+    key = "%s~%s~%s" % (owner, repo, branch)
+    r.register_script(UPDATE_SUMMARY_SCRIPT)(
+        keys=["summaries", get_weights_key(owner, repo, branch),
+              "status-seq", "summary-seqs", get_summary_key(key)],
+        args=[key, updated_at or "", ujson.dumps(key), delta,
+              "1" if replace else "0"])
+
+
+def _backfill_summaries(r):
+    # NOTE: queues written before the summaries existed
+    pipe = r.pipeline()
+    for owner, repo, branch in get_queues(r):
+        pulls = load_queue(r, owner, repo, branch)
+        if pulls:
+            pipe.hset("summaries", "%s~%s~%s" % (owner, repo, branch),
+                      max(p["updated_at"] for p in pulls))
+    pipe.execute()
+    return r.hgetall("summaries")
+
+
+def _split_seq(payload):
+    if payload:
+        seq, data = utils.to_str(payload).split(" ", 1)
+        return seq, data
+    return None, None
+
+
+def _load_status(r):
+    """Return the current sequence number and the status if it's up to date
+    """
+    seq, payload = r.mget("status-seq", "status")
+    seq = utils.to_str(seq) or "0"
+    status_seq, status = _split_seq(payload)
+    return seq, status if status_seq == seq else None
+
+
+def _build_summary(r, key, updated_at):
+    # NOTE: ~ is not allowed in git branch names
+    owner, repo, branch = key.split("~", 2)
+    pulls = load_queue(r, owner, repo, branch)
+    if pulls:
+        return ujson.dumps({
+            "owner": owner,
+            "repo": repo,
+            "branch": branch,
+            "pulls": pulls,
+            "updated_at": updated_at,
+        })
+
+
+def _build_status(r, seq):
+    """Build the status, only the outdated branch summaries are rebuilt"""
+    summaries = dict((utils.to_str(k), utils.to_str(v)) for k, v in
+                     (r.hgetall("summaries") or
+                      _backfill_summaries(r)).items())
+    keys = sorted(summaries)
+    parts = []
+    pipe = r.pipeline()
+    if keys:
+        seqs = r.hmget("summary-seqs", keys)
+        payloads = r.mget([get_summary_key(key) for key in keys])
+        for key, branch_seq, payload in zip(keys, seqs, payloads):
+            branch_seq = utils.to_str(branch_seq) or "0"
+            summary_seq, summary = _split_seq(payload)
+            if summary_seq != branch_seq:
+                summary = _build_summary(r, key, summaries[key])
+                if summary is None:
+                    continue
+                pipe.set(get_summary_key(key),
+                         "%s %s" % (branch_seq, summary))
+            parts.append(summary)
+    status = "[%s]" % ",".join(parts)
+    pipe.set("status", "%s %s" % (seq, status))
+    pipe.execute()
+    return status
+
+
+def _get_status(r):
+    seq, status = _load_status(r)
+    if status is None:
+        # NOTE: Only one reader rebuilds it, the others wait for it
+        with r.lock("status-lock", timeout=STATUS_LOCK_TIMEOUT):
+            seq, status = _load_status(r)
+            if status is None:
+                status = _build_status(r, seq)
+    return seq, status
+
+
+def get_status(r):
+    """Return the dashboard status json"""
+    return _get_status(r)[1]
+
+
+def get_status_snapshot(r):
+    """Return the dashboard status json with its sequence number
+
+    The deltas that follow this sequence number may already be in the
+    status, applying them again doesn't change it.
+    """
+    seq, status = _get_status(r)
+    return '{"seq": %s, "queues": %s}' % (int(seq), status)
+
+
+def load_train(r, owner, repo, branch):
+    payload = r.get(_get_key("train", owner, repo, branch))
+    if payload:
+        return ujson.loads(payload)
+
+
+def get_train_branch(r, owner, repo, sha):
+    """Return the branch of the merge train with this head sha"""
+    return utils.to_str(r.get(_get_key("train-sha", owner, repo, sha)))
+
+
+def save_train(r, owner, repo, branch, train):
+    pipe = r.pipeline()
+    pipe.setex(_get_key("train", owner, repo, branch),
+               config.MERGE_TRAIN_TIMEOUT, ujson.dumps(train))
+    pipe.setex(_get_key("train-sha", owner, repo, train["sha"]),
+               config.MERGE_TRAIN_TIMEOUT, branch)
+    pipe.execute()
+
+
+def delete_train(r, owner, repo, branch, train):
+    r.delete(_get_key("train", owner, repo, branch),
+             _get_key("train-sha", owner, repo, train["sha"]))
+
+
+def load_collaborators(r, installation_id, owner, repo):
+    """Return the cached collaborator ids, or None if unknown"""
+    payload = r.hget(get_collaborators_key(installation_id),
+                     "%s~%s" % (owner, repo))
+    if payload:
+        collaborators = ujson.loads(payload)
+        if collaborators["expires_at"] > time.time():
+            return set(collaborators["ids"])
+
+
+def save_collaborators(r, installation_id, owner, repo, ids, ttl):
+    r.hset(get_collaborators_key(installation_id), "%s~%s" % (owner, repo),
+           ujson.dumps({"ids": list(ids), "expires_at": time.time() + ttl}))
+
+
+def delete_collaborators(r, installation_id, owner=None, repo=None):
+    """Remove the collaborators of a repository, or of all of them"""
+    key = get_collaborators_key(installation_id)
+    if owner is None:
+        r.delete(key)
+    else:
+        r.hdel(key, "%s~%s" % (owner, repo))
+
+
+def load_ratelimit(r, installation_id):
+    payload = r.get("ratelimit~%s" % installation_id)
+    if payload:
+        return ujson.loads(payload)
+
+
+def save_ratelimit(r, installation_id, remaining, limit, reset):
+    r.set("ratelimit~%s" % installation_id, ujson.dumps({
+        "remaining": remaining, "limit": limit, "reset": reset}))
+
+
+def _migrate_legacy_queue(r, owner, repo, branch):
+    # NOTE: queues used to be stored as one json blob per branch
+    key = _get_key("queues", owner, repo, branch)
+    data = r.get(key)
+    if not data:
+        return []
+    try:
+        raw_pulls = ujson.loads(data)
+    except Exception:
+        # Old format
+        raw_pulls = ujson.loads(lz4.block.decompress(data))
+    LOG.info("%s, migrating %d pulls to the new cache format",
+             key, len(raw_pulls))
+    save_queue(r, None, owner, repo, branch, raw_pulls)
+    r.delete(key)
+    return raw_pulls
@@ -0,0 +1,22 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+
+# NOTE: The configuration requires them, the tests don't talk to github
+for name in ["BASE_URL", "INTEGRATION_ID", "PRIVATE_KEY", "OAUTH_CLIENT_ID",
+             "OAUTH_CLIENT_SECRET", "WEBHOOK_SECRET"]:
+    os.environ.setdefault("PASTAMAKER_%s" % name, "test")
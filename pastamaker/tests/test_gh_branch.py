@@ -0,0 +1,49 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+import fakeredis
+import mock
+
+from pastamaker import gh_branch
+from pastamaker import utils
+
+
+class TestProtection(unittest.TestCase):
+    def setUp(self):
+        self.r = fakeredis.FakeStrictRedis()
+        patcher = mock.patch.object(utils, "get_redis", return_value=self.r)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.g_repo = mock.Mock(full_name="owner/repo")
+        self.g_repo.owner.login = "owner"
+        self.g_repo.name = "repo"
+
+    @mock.patch.object(gh_branch, "protect")
+    @mock.patch.object(gh_branch, "is_protected", return_value=True)
+    def test_protect_if_needed_cached(self, is_protected, protect):
+        policy = {"required_status_checks": None}
+        gh_branch.protect_if_needed(self.g_repo, "master", policy)
+        gh_branch.protect_if_needed(self.g_repo, "master", policy)
+        self.assertEqual(1, is_protected.call_count)
+        self.assertFalse(protect.called)
+
+        # The cache is per policy
+        gh_branch.protect_if_needed(self.g_repo, "master",
+                                    {"required_status_checks": {}})
+        self.assertEqual(2, is_protected.call_count)
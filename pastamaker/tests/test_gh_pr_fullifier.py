@@ -0,0 +1,62 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+import fakeredis
+import mock
+
+from pastamaker import gh_pr_fullifier
+from pastamaker import utils
+
+
+class TestTravisCache(unittest.TestCase):
+    def setUp(self):
+        self.r = fakeredis.FakeStrictRedis()
+        patcher = mock.patch.object(utils, "get_redis", return_value=self.r)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.objects = {
+            "/builds/42": {"build": {"id": 42, "state": "started",
+                                     "job_ids": [1, 2]}},
+            "/jobs/1": {"job": {"id": 1, "state": "passed"}},
+            "/jobs/2": {"job": {"id": 2, "state": "started"}},
+        }
+        session = mock.Mock()
+        session.get.side_effect = self.get
+        patcher = mock.patch.object(utils, "get_http_session",
+                                    return_value=session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, url, headers):
+        path = url[len(gh_pr_fullifier.TRAVIS_BASE_URL):]
+        return mock.Mock(status_code=200,
+                         json=mock.Mock(return_value=self.objects[path]))
+
+    def test_forget_restarted_job_of_running_build(self):
+        build = gh_pr_fullifier.get_travis_build("42")
+        self.assertEqual(["passed", "started"],
+                         [job["state"] for job in build["jobs"]])
+
+        # The finished job is restarted
+        self.objects["/jobs/1"]["job"]["state"] = "created"
+        gh_pr_fullifier.forget_travis_build("42")
+
+        build = gh_pr_fullifier.get_travis_build("42")
+        self.assertEqual(["created", "started"],
+                         [job["state"] for job in build["jobs"]])
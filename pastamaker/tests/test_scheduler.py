@@ -0,0 +1,57 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+import fakeredis
+import mock
+
+from pastamaker import scheduler
+from pastamaker import storage
+from pastamaker.tests import test_storage
+
+
+class TestProceed(unittest.TestCase):
+    def setUp(self):
+        self.r = fakeredis.FakeStrictRedis()
+        self.queue = mock.Mock()
+
+    def test_proceed_ready_queues(self):
+        storage.save_pull(self.r, 42, "owner", "repo", "master",
+                          test_storage.get_raw_pull(1, weight=11))
+        storage.save_pull(self.r, 42, "owner", "repo", "stable",
+                          test_storage.get_raw_pull(2, weight=5))
+
+        self.assertEqual(1, scheduler.proceed_ready_queues(self.r,
+                                                           self.queue))
+        self.queue.enqueue.assert_called_once_with(
+            "pastamaker.worker.event_handler", "proceed", {
+                "installation": {"id": 42},
+                "repository": {"name": "repo", "owner": {"login": "owner"}},
+                "branch": "master",
+                "number": 1,
+            })
+
+        # Same head sha, not proceeded again
+        scheduler.release_proceed(self.r, "owner", "repo", "master")
+        self.assertEqual(0, scheduler.proceed_ready_queues(self.r,
+                                                           self.queue))
+
+        raw_pull = test_storage.get_raw_pull(1, weight=11)
+        raw_pull["head"]["sha"] = "new-sha"
+        storage.save_pull(self.r, 42, "owner", "repo", "master", raw_pull)
+        self.assertEqual(1, scheduler.proceed_ready_queues(self.r,
+                                                           self.queue))
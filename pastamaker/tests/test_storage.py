@@ -0,0 +1,109 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+import fakeredis
+import mock
+import ujson
+
+from pastamaker import storage
+
+
+def get_raw_pull(number, updated_at="2018-01-01T00:00:00Z", weight=0):
+    return {
+        "number": number,
+        "state": "open",
+        "updated_at": updated_at,
+        "pastamaker_weight": weight,
+        "head": {"sha": "sha-%s" % number},
+    }
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        # NOTE: Like utils.get_redis(), replies are not decoded
+        self.r = fakeredis.FakeStrictRedis()
+
+    def test_register_and_list(self):
+        storage.save_pull(self.r, 42, "owner", "repo", "master",
+                          get_raw_pull(1))
+        storage.save_pull(self.r, 42, "owner", "repo", "stable/1.0",
+                          get_raw_pull(2))
+
+        self.assertEqual(set(["42"]), storage.get_installations(self.r))
+        self.assertEqual([("owner", "repo", "master"),
+                          ("owner", "repo", "stable/1.0")],
+                         sorted(storage.get_installation_queues(self.r, 42)))
+        self.assertEqual([("owner", "repo", "master"),
+                          ("owner", "repo", "stable/1.0")],
+                         sorted(storage.get_queues(self.r)))
+
+        storage.delete_pull(self.r, 42, "owner", "repo", "master", 1,
+                            "sha-1")
+        self.assertEqual([("owner", "repo", "stable/1.0")],
+                         storage.get_queues(self.r))
+
+        storage.delete_pull(self.r, 42, "owner", "repo", "stable/1.0", 2,
+                            "sha-2")
+        self.assertEqual([], storage.get_queues(self.r))
+        self.assertEqual(set(), storage.get_installations(self.r))
+
+
+class TestStatus(unittest.TestCase):
+    def setUp(self):
+        self.r = fakeredis.FakeStrictRedis()
+        storage.save_pull(self.r, 42, "owner", "repo", "master",
+                          get_raw_pull(1))
+        storage.save_pull(self.r, 42, "owner", "repo", "stable",
+                          get_raw_pull(2))
+
+    def get_status(self):
+        with mock.patch.object(storage, "load_queue",
+                               wraps=storage.load_queue) as load_queue:
+            status = ujson.loads(storage.get_status(self.r))
+        return status, sorted(c[0][3] for c in load_queue.call_args_list)
+
+    def test_status_built_once_per_version(self):
+        status, loaded = self.get_status()
+        self.assertEqual(["master", "stable"],
+                         [q["branch"] for q in status])
+        self.assertEqual(["master", "stable"], loaded)
+
+        status, loaded = self.get_status()
+        self.assertEqual(2, len(status))
+        self.assertEqual([], loaded)
+
+    def test_status_rebuilds_written_branches_only(self):
+        self.get_status()
+        storage.save_pull(self.r, 42, "owner", "repo", "master",
+                          get_raw_pull(3, "2018-02-01T00:00:00Z"))
+        status, loaded = self.get_status()
+        self.assertEqual(["master"], loaded)
+        self.assertEqual([[3, 1], [2]],
+                         [[p["number"] for p in q["pulls"]] for q in status])
+        self.assertEqual("2018-02-01T00:00:00Z", status[0]["updated_at"])
+
+        storage.delete_pull(self.r, 42, "owner", "repo", "stable", 2,
+                            "sha-2")
+        status, loaded = self.get_status()
+        self.assertEqual([], loaded)
+        self.assertEqual(["master"], [q["branch"] for q in status])
+
+    def test_status_snapshot(self):
+        snapshot = ujson.loads(storage.get_status_snapshot(self.r))
+        self.assertEqual(2, snapshot["seq"])
+        self.assertEqual(2, len(snapshot["queues"]))
@@ -0,0 +1,70 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2018 Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import unittest
+
+import mock
+
+from pastamaker import utils
+
+
+class UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return "UTC"
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+class TestInstallation(unittest.TestCase):
+    def setUp(self):
+        utils.INSTALLATIONS.clear()
+        self.addCleanup(utils.INSTALLATIONS.clear)
+
+    def _test_get_installation_twice(self, expires_at):
+        integration = mock.Mock()
+        integration.get_access_token.return_value = mock.Mock(
+            token="token", expires_at=expires_at)
+        with mock.patch.object(utils, "get_integration",
+                               return_value=integration):
+            first = utils.get_github(42)
+            second = utils.get_github(42)
+        self.assertIs(first, second)
+        self.assertEqual(1, integration.get_access_token.call_count)
+
+    def test_get_installation_twice_naive(self):
+        self._test_get_installation_twice(
+            datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+
+    def test_get_installation_twice_aware(self):
+        self._test_get_installation_twice(
+            datetime.datetime.now(UTC()) + datetime.timedelta(hours=1))
+
+    def test_get_installation_expired(self):
+        integration = mock.Mock()
+        integration.get_access_token.return_value = mock.Mock(
+            token="token",
+            expires_at=datetime.datetime.now(UTC()) +
+            datetime.timedelta(minutes=1))
+        with mock.patch.object(utils, "get_integration",
+                               return_value=integration):
+            utils.get_github(42)
+            utils.get_github(42)
+        self.assertEqual(2, integration.get_access_token.call_count)
@@ -14,17 +14,19 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import datetime
 import hashlib
 import hmac
-from httplib import HTTPSConnection
 import logging
 import os
 import sys
 
 import daiquiri
+import github
 from github import GithubException
 import redis
-import six
+import requests
+import requests.adapters
 import ujson
 
 from pastamaker import config
@@ -35,6 +37,21 @@ LOG = logging.getLogger(__name__)
 global REDIS_CONNECTION
 REDIS_CONNECTION = None
 
+global INTEGRATION
+INTEGRATION = None
+
+# NOTE: installation id -> {"expires_at": ..., "github": ..., "repos": ...}
+INSTALLATIONS = {}
+
+# NOTE: Installation tokens are valid one hour, renew them a bit before
+TOKEN_RENEW_MARGIN = datetime.timedelta(minutes=5)
+
+global HTTP_SESSION
+HTTP_SESSION = None
+
+global HTTP_STATS_FLUSHED
+HTTP_STATS_FLUSHED = {}
+
 
 def get_redis_url():
     for envvar in ["REDIS_URL", "REDISTOGO_URL", "REDISCLOUD_URL"]:
@@ -53,6 +70,61 @@ def get_redis():
     return REDIS_CONNECTION
 
 
+def to_str(value):
+    """Return a redis reply as str
+
+    The connection doesn't decode the replies, rq needs bytes.
+    """
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode("utf-8")
+    return value
+
+
+def get_http_session():
+    """Return the http session shared by all outgoing requests
+
+    Connections are kept alive and reused, http_pool_hosts hosts are kept
+    in the pool with at most http_pool_maxsize connections per host.
+    """
+    global HTTP_SESSION
+    if HTTP_SESSION is None:
+        HTTP_SESSION = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=config.HTTP_POOL_HOSTS,
+            pool_maxsize=config.HTTP_POOL_MAXSIZE)
+        HTTP_SESSION.mount("http://", adapter)
+        HTTP_SESSION.mount("https://", adapter)
+    return HTTP_SESSION
+
+
+def get_http_stats():
+    opened = done = 0
+    if HTTP_SESSION is not None:
+        for adapter in set(HTTP_SESSION.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                opened += pool.num_connections
+                done += pool.num_requests
+    return {"http_connections_opened": opened,
+            "http_connections_reused": done - opened}
+
+
+def flush_http_stats(r):
+    """Add the http stats of this process since the last call to redis"""
+    global HTTP_STATS_FLUSHED
+    current = get_http_stats()
+    for name, value in current.items():
+        amount = value - HTTP_STATS_FLUSHED.get(name, 0)
+        if amount > 0:
+            incr_stats(r, name, amount)
+    HTTP_STATS_FLUSHED = current
+
+
+def incr_stats(r, name, amount=1):
+    r.hincrby("stats", name, amount)
+
+
 def setup_logging():
     daiquiri.setup(
         outputs=[daiquiri.output.Stream(
@@ -76,40 +148,84 @@ def compute_hmac(data):
 
 def get_installations(integration):
     # FIXME(sileht): Need to be in github libs
-    conn = HTTPSConnection("api.github.com")
-    conn.request(
-        method="GET",
-        url="/app/installations",
+    response = get_http_session().get(
+        "https://api.github.com/app/installations",
         headers={
             "Authorization": "Bearer {}".format(integration.create_jwt()),
             "Accept": "application/vnd.github.machine-man-preview+json",
             "User-Agent": "PyGithub/Python"
         },
     )
-    response = conn.getresponse()
-    response_text = response.read()
-    if six.PY3:
-        response_text = response_text.decode('utf-8')
-    conn.close()
-
-    if response.status == 200:
-        return ujson.loads(response_text)
-    elif response.status == 403:
+
+    if response.status_code == 200:
+        return ujson.loads(response.text)
+    elif response.status_code == 403:
         raise GithubException.BadCredentialsException(
-            status=response.status,
-            data=response_text
+            status=response.status_code,
+            data=response.text
         )
-    elif response.status == 404:
+    elif response.status_code == 404:
         raise GithubException.UnknownObjectException(
-            status=response.status,
-            data=response_text
+            status=response.status_code,
+            data=response.text
         )
     raise GithubException.GithubException(
-        status=response.status,
-        data=response_text
+        status=response.status_code,
+        data=response.text
     )
 
 
+def get_integration():
+    global INTEGRATION
+    if INTEGRATION is None:
+        INTEGRATION = github.GithubIntegration(config.INTEGRATION_ID,
+                                               config.PRIVATE_KEY)
+    return INTEGRATION
+
+
+def _get_installation(installation_id):
+    installation = INSTALLATIONS.get(installation_id)
+    if (installation is None or installation["expires_at"] -
+            TOKEN_RENEW_MARGIN < datetime.datetime.utcnow()):
+        LOG.info("installation %s, getting a new access token",
+                 installation_id)
+        auth = get_integration().get_access_token(installation_id)
+        expires_at = auth.expires_at
+        # NOTE: Recent PyGithub returns timezone aware datetimes
+        if expires_at.tzinfo is not None:
+            expires_at = (expires_at -
+                          expires_at.utcoffset()).replace(tzinfo=None)
+        installation = INSTALLATIONS[installation_id] = {
+            "expires_at": expires_at,
+            "github": github.Github(auth.token),
+            "repos": {},
+        }
+    return installation
+
+
+def get_github(installation_id):
+    """Return a github client for this installation
+
+    The client and its access token are reused until the token expires.
+    """
+    return _get_installation(installation_id)["github"]
+
+
+def get_repository(installation_id, owner, name):
+    """Return the github client, user and repository of an installation
+
+    Like the client, user and repository are reused until the token expires.
+    """
+    installation = _get_installation(installation_id)
+    g = installation["github"]
+    key = (owner, name)
+    if key not in installation["repos"]:
+        user = g.get_user(owner)
+        installation["repos"][key] = (user, user.get_repo(name))
+    user, repo = installation["repos"][key]
+    return g, user, repo
+
+
 def get_installation_id(integration, owner):
     installations = get_installations(integration)
     for install in installations:
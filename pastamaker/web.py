@@ -24,14 +24,13 @@ import logging
 import os
 
 import flask
-import github
-import lz4.block
-import requests
 import rq
 import rq_dashboard
 import ujson
 
 from pastamaker import config
+from pastamaker import gh_branch
+from pastamaker import storage
 from pastamaker import utils
 from pastamaker import worker
 
@@ -69,16 +68,13 @@ def auth():
 def refresh(owner, repo, refresh_ref):
     authentification()
 
-    integration = github.GithubIntegration(config.INTEGRATION_ID,
-                                           config.PRIVATE_KEY)
-
-    installation_id = utils.get_installation_id(integration, owner)
+    installation_id = utils.get_installation_id(utils.get_integration(),
+                                                owner)
     if not installation_id:
         flask.abort(404, "%s have not installed pastamaker" % owner)
 
     if refresh_ref == "full":
-        token = integration.get_access_token(installation_id).token
-        g = github.Github(token)
+        g = utils.get_github(installation_id)
         r = g.get_repo("%s/%s" % (owner, repo))
         pulls = r.get_pulls()
         branches = set([p.base.ref for p in pulls])
@@ -114,14 +110,10 @@ def refresh(owner, repo, refresh_ref):
 def refresh_all():
     authentification()
 
-    integration = github.GithubIntegration(config.INTEGRATION_ID,
-                                           config.PRIVATE_KEY)
-
     counts = [0, 0, 0]
-    for install in utils.get_installations(integration):
+    for install in utils.get_installations(utils.get_integration()):
         counts[0] += 1
-        token = integration.get_access_token(install["id"]).token
-        g = github.Github(token)
+        g = utils.get_github(install["id"])
         i = g.get_installation(install["id"])
 
         for repo in i.get_repos():
@@ -143,39 +135,18 @@ def refresh_all():
 
 @app.route("/queue/<owner>/<repo>/<path:branch>")
 def queue(owner, repo, branch):
-    return get_redis().get("queues~%s~%s~%s" % (owner, repo, branch)) or "[]"
-
-
-def _get_status(r):
-    queues = []
-    for key in r.keys("queues~*~*~*"):
-        _, owner, repo, branch = key.split("~")
-        updated_at = None
-
-        payload = r.get(key)
-        if payload:
-            try:
-                pulls = ujson.loads(payload)
-            except Exception:
-                # Old format
-                payload = lz4.block.decompress(payload)
-                pulls = ujson.loads(payload)
-
-            updated_at = list(sorted([p["updated_at"] for p in pulls]))[-1]
-        queues.append({
-            "owner": owner,
-            "repo": repo,
-            "branch": branch,
-            "pulls": pulls,
-            "updated_at": updated_at,
-        })
-    return ujson.dumps(queues)
+    return ujson.dumps(storage.load_queue(get_redis(), owner, repo, branch))
+
+
+@app.route("/stats")
+def stats():
+    utils.flush_http_stats(get_redis())
+    return ujson.dumps(get_redis().hgetall("stats"))
 
 
 @app.route("/status")
 def status():
-    r = get_redis()
-    return _get_status(r)
+    return storage.get_status(get_redis())
 
 
 def stream_message(_type, data):
@@ -184,7 +155,7 @@ def stream_message(_type, data):
 
 def stream_generate():
     r = get_redis()
-    yield stream_message("refresh", _get_status(r))
+    yield stream_message("refresh", storage.get_status(r))
     yield stream_message("rq-refresh", get_queue().count)
     pubsub = r.pubsub()
     pubsub.subscribe("update")
@@ -197,7 +168,29 @@ def stream_generate():
         if message is None:
             yield stream_message("ping", "{}")
         elif message["channel"] == "update":
-            yield stream_message("refresh", _get_status(r))
+            yield stream_message("refresh", storage.get_status(r))
+            yield stream_message("rq-refresh", get_queue().count)
+        elif message["channel"] == "rq-update":
+            yield stream_message("rq-refresh", get_queue().count)
+
+
+def stream_delta_generate():
+    r = get_redis()
+    # NOTE: Subscribe before getting the snapshot, so no delta is lost.
+    # Clients ignore the deltas older than the snapshot.
+    pubsub = r.pubsub()
+    pubsub.subscribe("status-delta")
+    pubsub.subscribe("rq-update")
+    yield stream_message("snapshot", storage.get_status_snapshot(r))
+    yield stream_message("rq-refresh", get_queue().count)
+    while True:
+        message = pubsub.get_message(timeout=50.0)
+        if message is None:
+            yield stream_message("ping", "{}")
+        elif message["type"] != "message":
+            continue
+        elif message["channel"] == "status-delta":
+            yield stream_message("delta", message["data"])
             yield stream_message("rq-refresh", get_queue().count)
         elif message["channel"] == "rq-update":
             yield stream_message("rq-refresh", get_queue().count)
@@ -205,7 +198,11 @@ def stream_generate():
 
 @app.route('/status/stream')
 def stream():
-    return flask.Response(flask.stream_with_context(stream_generate()),
+    if flask.request.args.get("delta"):
+        generator = stream_delta_generate()
+    else:
+        generator = stream_generate()
+    return flask.Response(flask.stream_with_context(generator),
                           mimetype="text/event-stream")
 
 
@@ -219,8 +216,30 @@ def event_handler():
 
     if event_type in ["refresh", "pull_request", "status",
                       "pull_request_review"]:
-        get_queue().enqueue(worker.event_handler, event_type, data)
+        worker.push_event(get_redis(), get_queue(), event_type, data)
         get_redis().publish("rq-update", "noop")
+    elif event_type == "member":
+        storage.delete_collaborators(get_redis(), data["installation"]["id"],
+                                     data["repository"]["owner"]["login"],
+                                     data["repository"]["name"])
+    elif event_type in ["membership", "team", "organization"]:
+        # NOTE: Teams can give access to any repository of the organization
+        storage.delete_collaborators(get_redis(), data["installation"]["id"])
+    elif event_type == "branch_protection_rule":
+        owner = data["repository"]["owner"]["login"]
+        repo = data["repository"]["name"]
+        gh_branch.delete_protection_cache(
+            get_redis(), owner, repo,
+            storage.get_branches(get_redis(), owner, repo))
+    elif (event_type == "push" and data["ref"] ==
+          "refs/heads/%s" % data["repository"]["default_branch"]):
+        for commit in data["commits"]:
+            if ".mergify.yml" in (commit["added"] + commit["modified"] +
+                                  commit["removed"]):
+                gh_branch.delete_policy_cache(
+                    get_redis(), data["repository"]["owner"]["login"],
+                    data["repository"]["name"])
+                break
 
     if "repository" in data:
         repo_name = data["repository"]["full_name"]
@@ -290,18 +309,19 @@ def login():
 @app.route("/logged/<installation_id>")
 def logged(installation_id):
     code = flask.request.args.get('code')
-    r = requests.post("https://github.com/login/oauth/access_token",
-                      params=dict(
-                          client_id=config.OAUTH_CLIENT_ID,
-                          client_secret=config.OAUTH_CLIENT_SECRET,
-                          code=code,
-                      ), headers={'Accept': 'application/json'})
+    session = utils.get_http_session()
+    r = session.post("https://github.com/login/oauth/access_token",
+                     params=dict(
+                         client_id=config.OAUTH_CLIENT_ID,
+                         client_secret=config.OAUTH_CLIENT_SECRET,
+                         code=code,
+                     ), headers={'Accept': 'application/json'})
     r.raise_for_status()
     token = r.json().get('access_token')
     if not token:
         return flask.abort(400, 'Invalid callback code')
 
-    r = requests.get(
+    r = session.get(
         "https://api.github.com/user/installations/%s/repositories" %
         installation_id,
         headers={"Accept": "application/vnd.github.machine-man-preview+json",
@@ -16,44 +16,226 @@
 
 
 import logging
+import time
 
 import github
 import rq
 import rq.worker
+import ujson
 
 from pastamaker import config
 from pastamaker import engine
+from pastamaker import gh_branch
+from pastamaker import gh_etag
 from pastamaker import gh_pr
+from pastamaker import gh_update_branch
+from pastamaker import scheduler
+from pastamaker import storage
 from pastamaker import utils
 
 LOG = logging.getLogger(__name__)
 
+# NOTE: Pending events are dropped if no job picks them up in this delay
+COALESCING_TTL = 3600
+
+
+def get_coalescing_key(r, event_type, data):
+    owner = data["repository"]["owner"]["login"]
+    repo = data["repository"]["name"]
+    if "pull_request" in data:
+        return "events~%s~%s~%s~%s" % (owner, repo,
+                                       data["pull_request"]["base"]["ref"],
+                                       data["pull_request"]["number"])
+    elif event_type == "status":
+        index = storage.get_sha_index(r, owner, repo, data["sha"])
+        if index:
+            return "events~%s~%s~%s~%s" % (owner, repo, index["branch"],
+                                           index["number"])
+        return "events~%s~%s~sha~%s" % (owner, repo, data["sha"])
+
+
+def push_event(r, queue, event_type, data):
+    """Queue an event for the worker
+
+    Events of the same pull request are appended to a pending list, only
+    the first one enqueues a job. All events received until the job starts
+    are handled by this job at once.
+    """
+    key = get_coalescing_key(r, event_type, data)
+    if key is None:
+        queue.enqueue(event_handler, event_type, data)
+        return
+
+    pipe = r.pipeline()
+    pipe.rpush(key, ujson.dumps([event_type, data]))
+    pipe.expire(key, COALESCING_TTL)
+    pending = pipe.execute()[0]
+    utils.incr_stats(r, "events_received")
+    if pending == 1:
+        queue.enqueue(coalesced_event_handler, key)
+    else:
+        utils.incr_stats(r, "events_coalesced")
+
+
+def coalesced_event_handler(key):
+    r = utils.get_redis()
+    # NOTE: Jobs of the same key drain and handle their events one after the
+    # other, otherwise an older batch could be saved over a newer one
+    with r.lock("%s~lock" % key, timeout=config.BRANCH_LOCK_TIMEOUT):
+        pipe = r.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        events = [ujson.loads(e) for e in pipe.execute()[0]]
+        if not events:
+            return
+        LOG.info("%s, handling %d events", key, len(events))
+        _handle_events(events)
+
 
 def event_handler(event_type, data):
     """Everything start here"""
+    _handle_events([(event_type, data)])
+
+
+def deferred_event_handler(events):
+    _handle_events(events)
+
+
+def defer_events(r, events, timestamp):
+    LOG.info("deferring %d events to %s", len(events), timestamp)
+    utils.incr_stats(r, "events_deferred", len(events))
+    scheduler.enqueue_at(r, timestamp, deferred_event_handler, events)
+
+
+def _is_merge_critical(r, events):
+    """Returns True if one of the events is about the top of a queue"""
+    for event_type, data in events:
+        if event_type == "refresh":
+            return True
+        owner = data["repository"]["owner"]["login"]
+        repo = data["repository"]["name"]
+        if "pull_request" in data:
+            branch = data["pull_request"]["base"]["ref"]
+            number = data["pull_request"]["number"]
+        elif event_type == "status":
+            index = storage.get_sha_index(r, owner, repo, data["sha"])
+            if not index:
+                continue
+            branch, number = index["branch"], index["number"]
+        elif event_type in ["mergeable_state", "branch_updated", "proceed"]:
+            branch, number = data["branch"], data["number"]
+        else:
+            continue
+        if storage.get_queue_head(r, owner, repo, branch) == number:
+            return True
+    return False
+
 
-    integration = github.GithubIntegration(config.INTEGRATION_ID,
-                                           config.PRIVATE_KEY)
-    token = integration.get_access_token(data["installation"]["id"]).token
-    g = github.Github(token)
+def _release_proceeds(r, events):
+    for event_type, data in events:
+        if event_type == "proceed":
+            scheduler.release_proceed(
+                r, data["repository"]["owner"]["login"],
+                data["repository"]["name"], data["branch"])
+
+
+def _handle_events(events):
+    _, data = events[-1]
+    installation_id = data["installation"]["id"]
+    r = utils.get_redis()
+
+    # NOTE: Don't waste the remaining quota for events that can't lead to a
+    # merge, and don't even try when nothing remains
+    ratelimit = storage.load_ratelimit(r, installation_id)
+    if ratelimit and ratelimit["reset"] > time.time() and (
+            ratelimit["remaining"] <= 0 or
+            (ratelimit["remaining"] < config.RATELIMIT_RESERVE and
+             not _is_merge_critical(r, events))):
+        defer_events(r, events, ratelimit["reset"])
+        _release_proceeds(r, events)
+        return
+
+    g = utils.get_github(installation_id)
     try:
-        user = g.get_user(data["repository"]["owner"]["login"])
-        repo = user.get_repo(data["repository"]["name"])
+        g, user, repo = utils.get_repository(
+            installation_id,
+            data["repository"]["owner"]["login"],
+            data["repository"]["name"])
 
-        engine.PastaMakerEngine(g, data["installation"]["id"],
-                                user, repo).handle(event_type, data)
+        engine.PastaMakerEngine(g, installation_id,
+                                user, repo).handle_events(events)
     except github.RateLimitExceededException:
         LOG.error("rate limit reached")
+        defer_events(r, events, g.rate_limiting_resettime)
+    finally:
+        # NOTE: Github.rate_limiting would call GET /rate_limit when no
+        # request has been done yet
+        requester = g._Github__requester
+        remaining, limit = requester.rate_limiting
+        if remaining >= 0:
+            storage.save_ratelimit(r, installation_id, remaining, limit,
+                                   requester.rate_limiting_resettime)
+        utils.flush_http_stats(r)
+        _release_proceeds(r, events)
+
+
+def branch_update_handler(installation_id, owner, repo_name, branch, number,
+                          sha):
+    """Update the branch of a pull request, then tell the engine
+
+    Failures are reported too, even the job timeout, otherwise the engine
+    would queue the same update again.
+    """
+    r = utils.get_redis()
+    updated = False
+    try:
+        g, user, repo = utils.get_repository(installation_id, owner,
+                                             repo_name)
+        pull = repo.get_pull(number)
+        if pull.state != "open" or pull.head.sha != sha:
+            LOG.info("%s, branch update cancelled, pull request has changed",
+                     pull.pretty())
+            return
+
+        token = utils.to_str(r.get("installation-token-%s" %
+                                   installation_id))
+        strategy = gh_branch.get_update_branch_strategy(repo)
+        updated = pull.pastamaker_update_branch(token, strategy=strategy)
+    except Exception:
+        LOG.exception("%s/%s/pull/%s@%s, branch update failed",
+                      owner, repo_name, number, branch)
+    push_event(r, rq.Queue(connection=r), "branch_updated", {
+        "installation": {"id": installation_id},
+        "repository": {"name": repo_name, "owner": {"login": owner}},
+        "branch": branch,
+        "number": number,
+        "sha": sha,
+        "updated": updated,
+    })
+    r.publish("rq-update", "noop")
 
 
 def main():
     utils.setup_logging()
     config.log()
     gh_pr.monkeypatch_github()
+    gh_etag.monkeypatch_github()
     if config.FLUSH_REDIS_ON_STARTUP:
         utils.get_redis().flushall()
     with rq.Connection(utils.get_redis()):
-        worker = rq.Worker(['default'])
+        # NOTE: Don't fork for each job, github clients and tokens are cached
+        # in this process
+        worker = rq.SimpleWorker(['default'])
+        worker.work()
+
+
+def branch_updater_main():
+    utils.setup_logging()
+    config.log()
+    gh_pr.monkeypatch_github()
+    gh_etag.monkeypatch_github()
+    with rq.Connection(utils.get_redis()):
+        worker = rq.SimpleWorker([gh_update_branch.RQ_QUEUE])
         worker.work()
 
 